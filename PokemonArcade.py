@@ -17,22 +17,46 @@ import sys
 import time
 import datetime
 import asyncio
+import io
 import json
+import sqlite3
+import collections
+import urllib.parse
 import hashlib
+import glob
+import shutil
+import tempfile
+import itertools
+import multiprocessing
+import concurrent.futures
+
+# Startup phase timings, printed when the bot is online
+# Timing starts here, so importing the dependencies is included
+StartupPhases = {}
+StartupPhaseStart = time.perf_counter()
+
+def endStartupPhase(name):
+    global StartupPhaseStart
+    now = time.perf_counter()
+    StartupPhases[name] = now - StartupPhaseStart
+    StartupPhaseStart = now
 
 # External dependencies
 import discord
+import aiohttp
 from pyboy import PyBoy, WindowEvent
 from PIL import Image
+import numpy
 import PIL.ImageOps
 from pyboy.logger import log_level
+endStartupPhase("imports")
 
 # Set log level to warning as to not receive messages every frame
 log_level("WARNING")
 
-# Windows compatibility is not ok because of os.system calls:
-# - mv command in PA!Singleplayer Custom
-# - ln -sf command in PA!Singleplayer
+# Windows compatibility is not ok because of os.symlink:
+# - linkRom links every singleplayer save to it's rom in PA!Singleplayer
+# - Creating symlinks on Windows needs administrator rights or developer mode
 # These are absolutely vital to the bots functioning
 # There is another check in the PA!Singleplayer command
 # To ensure users don't get confused with broken functionality, we throw a generic error
@@ -48,7 +72,7 @@ else:
     exit()
 
 # Make sure we don't get errors from directories that don't exist later
-for dir in ["./CustomRoms", "./SinglePlayerSaves", "./screenshots"]:
+for dir in ["./CustomRoms", "./SinglePlayerSaves", "./BootSnapshots", "./Sessions"]:
     if not os.path.exists(dir):
         print("Creating directory: " + dir)
         os.mkdir(dir)
@@ -58,25 +82,471 @@ IconURL = Settings["IconURL"]
 SupportServerURL = Settings["SupportServerURL"]
 ImageChannelID = int(Settings["ImageChannelID"])
 RomLocations = Settings["RomLocations"]
+EmulatorWorkerCount = max(1, int(Settings.get("EmulatorWorkers", os.cpu_count() or 1)))
+# Amount of screenshot urls kept in memory, and in the database
+ScreenshotCacheMemorySize = int(Settings.get("ScreenshotCacheMemorySize", 4096))
+ScreenshotCacheMaxEntries = int(Settings.get("ScreenshotCacheMaxEntries", 250000))
+# Seconds before a cached url is considered stale, 0 to keep urls forever
+ScreenshotCacheExpiry = int(Settings.get("ScreenshotCacheExpiry", 72000))
+# Image format of uploaded frames, png or webp (lossless)
+FrameFormat = "webp" if str(Settings.get("FrameFormat", "png")).lower() == "webp" else "png"
+# Seconds without input before a single player game is saved to disk and it's emulator is stopped, 0 to never hibernate
+HibernateAfter = int(Settings.get("HibernateAfter", 600))
+# Maximum size of an uploaded custom rom, the largest Game Boy cartridges are 8MB
+MaxCustomRomSize = int(Settings.get("MaxCustomRomSize", 8 * 1024 * 1024))
+# Maximum amount of inputs in one PA!Do sequence
+MaxInputSequence = max(1, int(Settings.get("MaxInputSequence", 50)))
+# Maximum amount of seconds PA!Turbo can fast-forward
+MaxTurboSeconds = max(1, int(Settings.get("MaxTurboSeconds", 60)))
+# Seconds to collect single player reactions before running them as one sequence
+InputBatchWindow = float(Settings.get("InputBatchWindow", 0))
+# Seconds to collect frames that have to be uploaded, before sending them in one message
+UploadBatchWindow = float(Settings.get("UploadBatchWindow", 0.05))
+# Maximum amount of discord requests the outbound scheduler runs at the same time
+OutboundConcurrency = max(1, int(Settings.get("OutboundConcurrency", 16)))
+# Create the boot snapshots of all roms when the bot starts, instead of on first use
+PrewarmBootSnapshots = bool(Settings.get("PrewarmBootSnapshots", False))
+# Seconds between checkpoints of a game's input journal, 0 to disable journaling
+# Games are restored after a crash or restart from their last checkpoint and the inputs after it
+CheckpointInterval = int(Settings.get("CheckpointInterval", 300))
+# Boot the global game in the background when the bot is online, instead of when it's first joined
+BootGlobalGame = bool(Settings.get("BootGlobalGame", True))
+# User IDs allowed to see the bot's stats, the owner of the bot application always can
+AdminIDs = [int(userid) for userid in Settings.get("AdminIDs", [])]
+# Amount of booted instances kept ready for every rom in RomLocations, 0 to disable the warm pool
+WarmPoolSize = max(0, int(Settings.get("WarmPoolSize", 0)))
+# Seconds without a new game of a rom before it's ready instances are stopped
+WarmPoolIdleTime = int(Settings.get("WarmPoolIdleTime", 1800))
+# File the metrics are written to in the Prometheus text format, and the seconds between writes, 0 to disable
+MetricsFile = Settings.get("MetricsFile", "./PokemonArcade_Metrics.prom")
+MetricsInterval = int(Settings.get("MetricsInterval", 60))
+
+# Metrics
+# Stage timings keep their latest samples for percentiles, counters only go up
+# Gauges are read when the metrics are shown, from functions registered with gauge()
+class MetricsRegistry:
+    def __init__(self, samples=1024):
+        self.samples = samples
+        # Stage to [count, total seconds, latest samples]
+        self.timings = {}
+        self.counters = collections.Counter()
+        self.gauges = {}
+        self.started = time.monotonic()
+
+    def observe(self, stage, seconds):
+        timing = self.timings.get(stage)
+        if timing is None:
+            timing = self.timings.setdefault(stage, [0, 0.0, collections.deque(maxlen=self.samples)])
+        timing[0] += 1
+        timing[1] += seconds
+        timing[2].append(seconds)
+
+    def count(self, counter, amount=1):
+        self.counters[counter] += amount
+
+    def gauge(self, name, function):
+        self.gauges[name] = function
+
+    # Returns the p50, p95 and p99 of a stage in seconds
+    def getPercentiles(self, stage):
+        samples = sorted(self.timings[stage][2])
+        return [samples[min(len(samples) - 1, int(len(samples) * p))] for p in (0.5, 0.95, 0.99)]
+
+    def getGauges(self):
+        gauges = {}
+        for name, function in self.gauges.items():
+            try:
+                gauges[name] = function()
+            except:
+                pass
+        return gauges
+
+    # Short summary, for PA!Stats
+    def getSummary(self):
+        text = f"Uptime: {datetime.timedelta(seconds=int(time.monotonic() - self.started))}\n\n"
+        text += f"{'stage':<16}{'count':>8}{'p50':>9}{'p95':>9}{'p99':>9}\n"
+        for stage in sorted(self.timings):
+            percentiles = "".join(f"{p * 1000:>7.1f}ms" for p in self.getPercentiles(stage))
+            text += f"{stage:<16}{self.timings[stage][0]:>8}{percentiles}\n"
+        text += "\n" + "\n".join(f"{name}: {value}" for name, value in sorted(self.counters.items()))
+        text += "\n\n" + "\n".join(f"{name}: {value}" for name, value in sorted(self.getGauges().items()))
+        return text
+
+    # All metrics in the Prometheus text format
+    def getExposition(self):
+        lines = ["# TYPE pokemonarcade_stage_seconds summary"]
+        for stage in sorted(self.timings):
+            count, total, samples = self.timings[stage]
+            for quantile, value in zip(("0.5", "0.95", "0.99"), self.getPercentiles(stage)):
+                lines.append(f'pokemonarcade_stage_seconds{{stage="{stage}",quantile="{quantile}"}} {value:.6f}')
+            lines.append(f'pokemonarcade_stage_seconds_count{{stage="{stage}"}} {count}')
+            lines.append(f'pokemonarcade_stage_seconds_sum{{stage="{stage}"}} {total:.6f}')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE pokemonarcade_{name}_total counter")
+            lines.append(f"pokemonarcade_{name}_total {value}")
+        for name, value in sorted(self.getGauges().items()):
+            lines.append(f"# TYPE pokemonarcade_{name} gauge")
+            lines.append(f"pokemonarcade_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    # Write the metrics to a file every interval, the file is replaced so it's never read half written
+    async def run(self, path, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                with open(path + ".tmp", "w") as f:
+                    f.write(self.getExposition())
+                os.replace(path + ".tmp", path)
+            except OSError as e:
+                print(f"Could not write metrics to {path}: {e}")
+
+Metrics = MetricsRegistry()
+
+# Advance a pyboy instance without rendering
+# Only the frame that is captured gets rendered, by captureFrame
+def advance(pyboy, frames):
+    pyboy._rendering(False)
+    for i in range(frames):
+        pyboy.tick()
+
+# Boot snapshots
+# Booting a rom always ends in the same state, so it's saved once per rom and loaded for new games
+# Rom path to ((size, modification time), hash), so unchanged roms are not hashed again
+RomHashes = {}
+
+# Returns the hash of a rom's contents, links are followed so every link to a rom shares it's snapshot
+def getRomHash(rom):
+    path = os.path.realpath(rom)
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime_ns)
+    if path not in RomHashes or RomHashes[path][0] != key:
+        hash = hashlib.sha1()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                hash.update(chunk)
+        RomHashes[path] = (key, hash.hexdigest())
+    return RomHashes[path][1]
+
+def getBootSnapshotPath(rom):
+    return f"./BootSnapshots/{getRomHash(rom)}.state"
+
+def bootPyBoy(pyboy):
+    advance(pyboy, 2000)
+
+# Save a booted instance as the boot snapshot
+def saveBootSnapshot(pyboy, snapshot):
+    # Write to a temporary file first, other workers might be loading the snapshot
+    temporary = f"{snapshot}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as f:
+        pyboy.save_state(f)
+    os.replace(temporary, snapshot)
+
+# Create the boot snapshot of a rom if it doesn't exist yet
+def prepareBootSnapshot(rom):
+    snapshot = getBootSnapshotPath(rom)
+    if os.path.exists(snapshot):
+        return
+    # Boot a copy of the rom, so no saved game is loaded into the snapshot
+    directory = tempfile.mkdtemp()
+    try:
+        shutil.copyfile(rom, os.path.join(directory, "rom.gb"))
+        pyboy = PyBoy(os.path.join(directory, "rom.gb"), window_type="headless", debug=False, game_wrapper=False, sound=False)
+        pyboy.set_emulation_speed(0)
+        bootPyBoy(pyboy)
+        saveBootSnapshot(pyboy, snapshot)
+        pyboy.stop(save=False)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
 
 # We define startPyBoy before setting ChannelInfo with an instance of the game
 # Starts and returns a pyboy instance
-def startPyBoy(rom):
+# A state can be given to continue a game instead of booting it
+def startPyBoy(rom, state=None):
     pyboy = PyBoy(rom, window_type="headless", debug=False, game_wrapper=False, sound=False)
     pyboy.set_emulation_speed(0)
-    for i in range(2000):
-        pyboy.tick()
+    # A state is a path, or an open file
+    if isinstance(state, str):
+        with open(state, "rb") as f:
+            pyboy.load_state(f)
+        return pyboy
+    if state is not None:
+        pyboy.load_state(state)
+        return pyboy
+    # The saved game is part of a state, so only games without a save can start from the snapshot
+    if os.path.exists(rom + ".ram"):
+        bootPyBoy(pyboy)
+        return pyboy
+    snapshot = getBootSnapshotPath(rom)
+    if os.path.exists(snapshot):
+        with open(snapshot, "rb") as f:
+            pyboy.load_state(f)
+    else:
+        bootPyBoy(pyboy)
+        saveBootSnapshot(pyboy, snapshot)
     return pyboy
 
-ChannelInfo = {"global": {"type": "global", "instance": startPyBoy("./pokemonred.gb"), "message": None, "removecounter": -1, "permanent": True, "filepath": "./pokemonred.gb", "sessionid": "global", "refer": "global", "playercount": 0, "TimerActive": False, "UsersReacted": {}, "VoteCounts": {"🅰": 0, "🅱": 0, "⬆": 0, "⬇": 0, "⬅": 0, "➡": 0, "▶": 0, "🟦": 0, "🕐": 0}}}
+# Sessions
+# A session is a running game, hosted by a channel (refer) or "global"
+# Every channel displaying a session is a viewer, the host channel of a single player game included
+class Session:
+    __slots__ = ("type", "instance", "permanent", "filepath", "sessionid", "refer", "removecounter", "viewers", "votes", "inputs", "inputting", "inputtime", "lastactive", "statelock")
+
+    def __init__(self, type, instance, permanent, filepath, sessionid, refer):
+        self.type = type
+        self.instance = instance
+        self.permanent = permanent
+        self.filepath = filepath
+        self.sessionid = sessionid
+        self.refer = refer
+        self.removecounter = int(datetime.datetime.now().timestamp()) + 1800
+        # Channel id to viewer
+        self.viewers = {}
+        self.votes = VoteEngine()
+        # Single player inputs waiting for the running sequence to finish
+        self.inputs = []
+        self.inputting = False
+        # When the oldest waiting input arrived
+        self.inputtime = None
+        # When the emulator was last used, and the lock for hibernating and resuming it
+        self.lastactive = time.monotonic()
+        self.statelock = None
+
+    # Where the state of a hibernating session is saved
+    @property
+    def hibernatepath(self):
+        return self.filepath + ".hibernate.state"
+
+    # Where the input journal of the session is kept, None if journaling is disabled
+    @property
+    def journalpath(self):
+        return f"./Sessions/{self.sessionid}.journal" if CheckpointInterval > 0 else None
+
+    # Where the session and it's viewers are saved, to restore them after a restart
+    @property
+    def manifestpath(self):
+        return f"./Sessions/{self.sessionid}.json"
+
+    @property
+    def playercount(self):
+        return len(self.viewers)
+
+# Votes of a multiplayer session
+# Tallies are updated on every vote, and a round is reset as soon as it closes
+# The next round collects votes while the action of the previous one is still running
+class VoteEngine:
+    __slots__ = ("votes", "VoteCounts", "previousvoters", "closed", "lock")
+
+    def __init__(self):
+        # User id to emoji
+        self.votes = {}
+        self.VoteCounts = {"🅰": 0, "🅱": 0, "⬆": 0, "⬇": 0, "⬅": 0, "➡": 0, "▶": 0, "🟦": 0, "🕐": 0}
+        # Players that voted last round, a round closes early once they all voted again
+        # and there are at least as many votes as players in the session
+        self.previousvoters = set()
+        # Set when the open round should close, None when no round is open
+        self.closed = None
+        # Makes sure the actions of rounds run in order
+        self.lock = None
+
+    # Add or change a vote, returns True if the vote opened a new round
+    def vote(self, userid, emoji, playercount):
+        previous = self.votes.get(userid)
+        if previous is not None:
+            self.VoteCounts[previous] -= 1
+        self.votes[userid] = emoji
+        self.VoteCounts[emoji] += 1
+        opened = self.closed is None
+        if opened:
+            self.closed = asyncio.Event()
+        if len(self.votes) >= playercount and self.previousvoters.issubset(self.votes):
+            self.closed.set()
+        return opened
+
+    # Wait for the open round to close, then returns the winning emoji and the tallies
+    async def collect(self, playercount):
+        try:
+            await asyncio.wait_for(self.closed.wait(), min(playercount, 5))
+        except asyncio.TimeoutError:
+            pass
+        # The first emoji with the most votes wins
+        FinalEmoji = max(self.VoteCounts, key=self.VoteCounts.get)
+        VoteCounts = self.VoteCounts
+        # Start a clean round
+        self.previousvoters = set(self.votes)
+        self.votes = {}
+        self.VoteCounts = dict.fromkeys(VoteCounts, 0)
+        self.closed = None
+        return FinalEmoji, VoteCounts
+
+    def getLock(self):
+        # The lock is made here, so it belongs to the running event loop
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        return self.lock
+
+class Viewer:
+    __slots__ = ("channelid", "session", "message", "removecounter", "frame", "image")
+
+    def __init__(self, channelid, session, message, frame, image):
+        self.channelid = channelid
+        self.session = session
+        self.message = message
+        self.removecounter = int(datetime.datetime.now().timestamp()) + 1800
+        # Fingerprint and url of the frame the message is showing
+        self.frame = frame
+        self.image = image
+
+# All sessions and viewers, indexed by session id and channel id
+class SessionRegistry:
+    def __init__(self):
+        self.sessions = {}
+        self.channels = {}
+
+    def __contains__(self, channelid):
+        return channelid in self.channels
+
+    def __getitem__(self, channelid):
+        return self.channels[channelid]
+
+    def get(self, channelid):
+        return self.channels.get(channelid)
+
+    def getSession(self, sessionid):
+        return self.sessions.get(sessionid)
+
+    def addSession(self, session):
+        self.sessions[session.sessionid] = session
+        return session
+
+    def addViewer(self, session, channelid, message, frame=None, image=""):
+        viewer = Viewer(channelid, session, message, frame, image)
+        session.viewers[channelid] = viewer
+        self.channels[channelid] = viewer
+        self.saveManifest(session)
+        return viewer
+
+    def removeViewer(self, viewer):
+        viewer.session.viewers.pop(viewer.channelid, None)
+        if self.channels.get(viewer.channelid) is viewer:
+            self.channels.pop(viewer.channelid)
+        self.saveManifest(viewer.session)
+
+    # Removes a session and all of it's viewers, and returns the viewers
+    def removeSession(self, session):
+        if self.sessions.get(session.sessionid) is session:
+            self.sessions.pop(session.sessionid)
+        viewers = list(session.viewers.values())
+        for viewer in viewers:
+            self.removeViewer(viewer)
+        if os.path.exists(session.manifestpath):
+            os.remove(session.manifestpath)
+        return viewers
+
+    # Save a session and the messages of it's viewers, so they can be restored after a restart
+    def saveManifest(self, session):
+        if CheckpointInterval <= 0 or self.sessions.get(session.sessionid) is not session:
+            return
+        manifest = {"sessionid": session.sessionid, "type": session.type, "filepath": session.filepath, "permanent": session.permanent, "refer": session.refer, "viewers": [[viewer.channelid, viewer.message.id] for viewer in session.viewers.values()]}
+        with open(session.manifestpath + ".tmp", "w") as f:
+            f.write(json.dumps(manifest))
+        os.replace(session.manifestpath + ".tmp", session.manifestpath)
+
+ChannelInfo = SessionRegistry()
+# The global game is started when the bot is online, or when it's first joined
+GlobalSession = ChannelInfo.addSession(Session("global", None, True, RomLocations["red"], "global", "global"))
 # Maps emojis to buttons and the pressed (button) text
 emojiToButtonMap = {"🅰": [WindowEvent.PRESS_BUTTON_A, WindowEvent.RELEASE_BUTTON_A, "Pressed A"], "🅱": [WindowEvent.PRESS_BUTTON_B, WindowEvent.RELEASE_BUTTON_B, "Pressed B"], "⬆": [WindowEvent.PRESS_ARROW_UP, WindowEvent.RELEASE_ARROW_UP, "Pressed Up"], "⬇": [WindowEvent.PRESS_ARROW_DOWN, WindowEvent.RELEASE_ARROW_DOWN, "Pressed Down"], "⬅": [WindowEvent.PRESS_ARROW_LEFT, WindowEvent.RELEASE_ARROW_LEFT, "Pressed Left"], "➡": [WindowEvent.PRESS_ARROW_RIGHT, WindowEvent.RELEASE_ARROW_RIGHT, "Pressed Right"], "🟦": [WindowEvent.PRESS_BUTTON_SELECT, WindowEvent.RELEASE_BUTTON_SELECT, "Pressed Select"], "▶": [WindowEvent.PRESS_BUTTON_START, WindowEvent.RELEASE_BUTTON_START, "Pressed Start"]}
+# Maps PA!Do input names to emojis
+inputNameToEmojiMap = {"a": "🅰", "b": "🅱", "up": "⬆", "down": "⬇", "left": "⬅", "right": "➡", "start": "▶", "select": "🟦", "wait": "🕐"}
 # Nintendo Logo for "DRM" checking
 NintendoLogo = "CEED6666CC0D000B03730083000C000D0008111F8889000EDCCC6EE6DDDDD999BBBB67636E0EECCCDDDC999FBBB9333E"
 
 # Screenshot Cache database
-with open("ScreenshotCache.json", "r") as f:
-    ScreenshotCache = json.loads(f.read())
+# Urls are stored in sqlite, so a new screenshot costs a single row write
+# The most recently used urls are kept in memory
+class ScreenshotCacheStore:
+    def __init__(self, path, memorysize, maxentries, expiry):
+        self.memorysize = memorysize
+        self.maxentries = maxentries
+        self.expiry = expiry
+        # Hash to (url, expires), least recently used first
+        self.memory = collections.OrderedDict()
+        self.writes = 0
+        self.path = path
+        self.database = None
+
+    def getDatabase(self):
+        # The connection is made on first use, so emulator workers forked before that don't inherit it
+        if self.database is None:
+            self.database = sqlite3.connect(self.path)
+            # Write ahead logging makes a single insert cheap
+            self.database.execute("PRAGMA journal_mode=WAL")
+            self.database.execute("PRAGMA synchronous=NORMAL")
+            self.database.execute("CREATE TABLE IF NOT EXISTS screenshots (hash TEXT PRIMARY KEY, url TEXT NOT NULL, created INTEGER NOT NULL, expires INTEGER NOT NULL)")
+            self.database.execute("CREATE INDEX IF NOT EXISTS screenshots_created ON screenshots (created)")
+            self.database.commit()
+        return self.database
+
+    # Get the time a url stops being usable, 0 if it doesn't expire
+    def getExpiry(self, url, created):
+        expires = created + self.expiry if self.expiry > 0 else 0
+        # Discord attachment urls carry their own expiry time as hex
+        try:
+            ex = int(urllib.parse.parse_qs(urllib.parse.urlparse(url).query)["ex"][0], 16)
+            expires = min(expires, ex) if expires else ex
+        except (KeyError, ValueError):
+            pass
+        return expires
+
+    # Add an entry to memory, dropping the least recently used one if it's full
+    def remember(self, hash, url, expires):
+        self.memory[hash] = (url, expires)
+        self.memory.move_to_end(hash)
+        while len(self.memory) > self.memorysize:
+            self.memory.popitem(last=False)
+
+    # Returns the url for a hash, or None if it's not cached (anymore)
+    def get(self, hash):
+        if hash in self.memory:
+            url, expires = self.memory[hash]
+            self.memory.move_to_end(hash)
+        else:
+            row = self.getDatabase().execute("SELECT url, expires FROM screenshots WHERE hash = ?", (hash,)).fetchone()
+            if row is None:
+                return None
+            url, expires = row
+            self.remember(hash, url, expires)
+        if expires and expires <= int(time.time()):
+            # Stale url, it will be replaced by a new upload
+            self.memory.pop(hash, None)
+            return None
+        return url
+
+    def put(self, hash, url):
+        created = int(time.time())
+        expires = self.getExpiry(url, created)
+        database = self.getDatabase()
+        database.execute("INSERT OR REPLACE INTO screenshots (hash, url, created, expires) VALUES (?, ?, ?, ?)", (hash, url, created, expires))
+        database.commit()
+        self.remember(hash, url, expires)
+        self.writes += 1
+        # Every so often, clean up the database
+        if self.writes % 1000 == 0:
+            self.compact()
+
+    # Remove stale urls, and the oldest urls over the size limit
+    def compact(self):
+        database = self.getDatabase()
+        database.execute("DELETE FROM screenshots WHERE expires != 0 AND expires <= ?", (int(time.time()),))
+        database.execute("DELETE FROM screenshots WHERE hash IN (SELECT hash FROM screenshots ORDER BY created DESC LIMIT -1 OFFSET ?)", (self.maxentries,))
+        database.commit()
+        database.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+ScreenshotCache = ScreenshotCacheStore("ScreenshotCache.db", ScreenshotCacheMemorySize, ScreenshotCacheMaxEntries, ScreenshotCacheExpiry)
+# The old json cache is keyed by hashes of png files, which never match the frame fingerprints
+if os.path.exists("ScreenshotCache.json"):
+    print("ScreenshotCache.json is not used anymore, and can be removed")
+endStartupPhase("settings and cache")
 
 # Standardized Embed Code
 def GetEmbed(text):
@@ -85,88 +555,1066 @@ def GetEmbed(text):
 # Pushes a button on a pyboy instance
 def PressButton(pyboy, buttonPress, buttonRelease):
     pyboy.send_input(buttonPress)
-    for i in range(15):
-        pyboy.tick()
+    advance(pyboy, 15)
     pyboy.send_input(buttonRelease)
-    pyboy.tick()
+    advance(pyboy, 1)
 
 # Instruct a pyboy instance to press a button, and return status text
 def DoActionOnEmoji(pyboy, Emoji):
     EmbedText = ""
     if Emoji == "🕐":
-        for i in range(105):
-            pyboy.tick()
+        advance(pyboy, 105)
         EmbedText = "Waited 2 seconds"
     else:
         PressButton(pyboy, emojiToButtonMap[Emoji][0], emojiToButtonMap[Emoji][1])
         EmbedText = emojiToButtonMap[Emoji][2]
-    for i in range(15):
-        pyboy.tick()
+    advance(pyboy, 15)
     return EmbedText
 
-# Make a screenshot
-def screenshot(pyboy):
+# Fast-forward a pyboy instance, and return status text
+def FastForward(pyboy, seconds):
+    advance(pyboy, seconds * 60)
+    return f"Fast-forwarded {seconds} seconds"
+
+# Run a sequence of emojis on a pyboy instance, and return status text
+def DoActionsOnEmojis(pyboy, Emojis):
+    EmbedTexts = []
+    for Emoji in Emojis:
+        EmbedText = DoActionOnEmoji(pyboy, Emoji)
+        # Repeated presses are shown once, with a count
+        if EmbedTexts and EmbedTexts[-1][0] == EmbedText:
+            EmbedTexts[-1][1] += 1
+        else:
+            EmbedTexts.append([EmbedText, 1])
+    return "\n".join(EmbedText if count == 1 else f"{EmbedText} (x{count})" for EmbedText, count in EmbedTexts)
+
+# Parse a PA!Do input sequence like "up*5 a" into emojis, returns None if it's invalid
+def parseInputSequence(text):
+    Emojis = []
+    for token in text.lower().split():
+        name, _, count = token.partition("*")
+        if name not in inputNameToEmojiMap or (count and not count.isdecimal()):
+            return None
+        count = int(count) if count else 1
+        # Check the length before building the list, so a huge count can't stall the bot
+        if count > MaxInputSequence - len(Emojis):
+            return None
+        Emojis += [inputNameToEmojiMap[name]] * count
+    if not Emojis:
+        return None
+    return Emojis
+
+# Read the current frame of a pyboy instance
+# Returns a fingerprint of the raw framebuffer, and the frame to encode later
+def captureFrame(pyboy):
+    # Render the frame, the frame timing is kept the same as SCREENSHOT_RECORD used to
+    pyboy._rendering(True)
+    pyboy.tick()
+    screen = pyboy.botsupport_manager().screen()
+    fingerprint = hashlib.blake2b(screen.raw_screen_buffer(), digest_size=16).hexdigest()
+    # The raw buffer's color order differs between pyboy versions, the image is always RGB
+    return fingerprint, screen.screen_image()
+
+# Encode a captured frame, and return the image data
+# A Game Boy frame only uses a few colors, so it's encoded as a palette image
+def encodeFrame(frame, format=None):
+    pixels = numpy.asarray(frame.convert("RGB"))
+    # Pack every pixel into a single number to find the colors used
+    packed = (pixels[:, :, 0].astype(numpy.uint32) << 16) | (pixels[:, :, 1].astype(numpy.uint32) << 8) | pixels[:, :, 2]
+    colors, indices = numpy.unique(packed, return_inverse=True)
+    if len(colors) <= 256:
+        img = Image.fromarray(indices.reshape(packed.shape).astype(numpy.uint8), "P")
+        img.putpalette(numpy.stack([colors >> 16, colors >> 8, colors], axis=1).astype(numpy.uint8).tobytes())
+        # 4 shades fit in 2 bits per pixel
+        bits = 1 if len(colors) <= 2 else 2 if len(colors) <= 4 else 4 if len(colors) <= 16 else 8
+    else:
+        img = Image.fromarray(numpy.ascontiguousarray(pixels), "RGB")
+        bits = None
+    # Resize 3x, nearest neighbor, this only copies palette indices
+    img = img.resize((img.size[0] * 3, img.size[1] * 3), 0)
+    buffer = io.BytesIO()
+    if (format or FrameFormat) == "webp":
+        img.convert("RGB").save(buffer, "WEBP", lossless=True, quality=100, method=4)
+    elif bits is not None:
+        # Higher compression levels barely shrink these frames, but take almost twice as long
+        img.save(buffer, "PNG", bits=bits, compress_level=6)
+    else:
+        img.save(buffer, "PNG", compress_level=6)
+    return buffer.getvalue()
+
+# Emulator worker processes
+# PyBoy blocks while it emulates, so instances are hosted in worker processes instead of on the event loop
+# Every worker owns a shard of the instances, handlers send it commands over a pipe and await the result
+EmulatorWorkers = []
+InstanceIDs = itertools.count()
+
+class EmulatorError(Exception):
+    pass
+
+# Input journals
+# A journal starts with a checkpoint (the length of a state, and the state) followed by a json line for every input
+# A checkpoint replaces the whole file at once, so the inputs in a journal always belong to it's state
+class InputJournal:
+    def __init__(self, path, pyboy):
+        self.path = path
+        self.file = None
+        self.checkpoint(pyboy)
+
+    def checkpoint(self, pyboy):
+        state = io.BytesIO()
+        pyboy.save_state(state)
+        with open(self.path + ".tmp", "wb") as f:
+            f.write(len(state.getvalue()).to_bytes(8, "little"))
+            f.write(state.getvalue())
+        if self.file is not None:
+            self.file.close()
+        os.replace(self.path + ".tmp", self.path)
+        self.file = open(self.path, "ab")
+        self.checkpointed = time.monotonic()
+
+    # Add an input, a few bytes, and make a new checkpoint every CheckpointInterval seconds
+    def write(self, pyboy, command, args):
+        self.file.write(json.dumps([command, *args]).encode("utf-8") + b"\n")
+        self.file.flush()
+        if time.monotonic() - self.checkpointed >= CheckpointInterval:
+            self.checkpoint(pyboy)
+
+    # Close the journal, it's removed when the game is stopped
+    def close(self, remove):
+        self.file.close()
+        if remove:
+            os.remove(self.path)
+
+# Everything that advances a game is journaled, capturing a frame advances it by one frame
+ReplayCommands = {"action": DoActionOnEmoji, "sequence": DoActionsOnEmojis, "turbo": FastForward, "capture": lambda pyboy: advance(pyboy, 1)}
+
+# Start a game from the checkpoint of a journal, and replay the inputs after it without rendering
+def restoreJournal(rom, path):
+    with open(path, "rb") as f:
+        length = int.from_bytes(f.read(8), "little")
+        pyboy = startPyBoy(rom, io.BytesIO(f.read(length)))
+        for line in f:
+            try:
+                command, *args = json.loads(line)
+            except ValueError:
+                # The last input can be cut off by a crash
+                break
+            ReplayCommands[command](pyboy, *args)
+    return pyboy
+
+# Journals of the worker's instances, by instance id
+WorkerJournals = {}
+
+# Worker commands, called with the worker's instances and the id of the instance to use
+# Given a journal, the game is restored from it if it exists, and journaled after
+def workerStart(instances, instanceid, rom, state=None, journal=None):
+    if journal is not None and state is None and os.path.exists(journal):
+        instances[instanceid] = restoreJournal(rom, journal)
+    else:
+        instances[instanceid] = startPyBoy(rom, state)
+    if journal is not None:
+        WorkerJournals[instanceid] = InputJournal(journal, instances[instanceid])
+
+# Save the state of an instance and stop it, the saved game is saved too
+def workerHibernate(instances, instanceid, state):
+    with open(state + ".tmp", "wb") as f:
+        instances[instanceid].save_state(f)
+    os.replace(state + ".tmp", state)
+    workerStop(instances, instanceid, True)
+
+def workerAction(instances, instanceid, emoji):
+    return DoActionOnEmoji(instances[instanceid], emoji)
+
+def workerSequence(instances, instanceid, emojis):
+    return DoActionsOnEmojis(instances[instanceid], emojis)
+
+def workerTurbo(instances, instanceid, seconds):
+    return FastForward(instances[instanceid], seconds)
+
+# Captured frames per instance, by fingerprint, so they can be encoded after a cache miss
+WorkerFrames = {}
+
+def workerCapture(instances, instanceid):
+    fingerprint, frame = captureFrame(instances[instanceid])
+    frames = WorkerFrames.setdefault(instanceid, collections.OrderedDict())
+    frames[fingerprint] = frame
+    frames.move_to_end(fingerprint)
+    # Another command can capture a newer frame before the encode arrives, so keep a few
+    while len(frames) > 4:
+        frames.popitem(last=False)
+    return fingerprint
+
+def workerEncode(instances, instanceid, fingerprint):
+    return encodeFrame(WorkerFrames[instanceid][fingerprint])
+
+def workerPrewarm(instances, instanceid, rom):
+    prepareBootSnapshot(rom)
+
+# Warm pool instances run on a pool rom link, and move their save to the session's rom link when stopped
+WorkerSavePaths = {}
+
+def workerBind(instances, instanceid, rom, savepath, journal=None):
+    WorkerSavePaths[instanceid] = (rom, savepath)
+    if journal is not None:
+        WorkerJournals[instanceid] = InputJournal(journal, instances[instanceid])
+
+def workerStop(instances, instanceid, save):
+    WorkerFrames.pop(instanceid, None)
+    stopInstance(instanceid, instances.pop(instanceid), save)
+
+# Stopping a game removes it's journal, unless the bot is stopping and the game should be restored
+def stopInstance(instanceid, pyboy, save, restore=False):
+    pyboy.stop(save=save)
+    if instanceid in WorkerJournals:
+        WorkerJournals.pop(instanceid).close(not restore)
+    if instanceid in WorkerSavePaths:
+        rom, savepath = WorkerSavePaths.pop(instanceid)
+        if os.path.exists(rom + ".ram"):
+            os.replace(rom + ".ram", savepath + ".ram")
+        # Claimed pool links are removed by the bot
+        if os.path.lexists(rom):
+            os.remove(rom)
+
+WorkerCommands = {"start": workerStart, "action": workerAction, "sequence": workerSequence, "turbo": workerTurbo, "capture": workerCapture, "encode": workerEncode, "prewarm": workerPrewarm, "hibernate": workerHibernate, "bind": workerBind, "stop": workerStop}
+
+# Main loop of a worker process
+def emulatorWorkerMain(connection):
+    instances = {}
+    while True:
+        try:
+            command, instanceid, args = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        start = time.perf_counter()
+        try:
+            result = WorkerCommands[command](instances, instanceid, *args)
+            if command in ReplayCommands and instanceid in WorkerJournals:
+                WorkerJournals[instanceid].write(instances[instanceid], command, args)
+        except Exception as e:
+            connection.send((False, f"{command} failed: {e!r}", time.perf_counter() - start))
+        else:
+            connection.send((True, result, time.perf_counter() - start))
+    # The bot stopped, save all games, and keep their journals to restore them
+    for instanceid, pyboy in instances.items():
+        try:
+            stopInstance(instanceid, pyboy, True, restore=True)
+        except:
+            pass
+
+class EmulatorWorker:
+    def __init__(self, workerid):
+        self.workerid = workerid
+        self.instancecount = 0
+        self.connection, workerconnection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=emulatorWorkerMain, args=(workerconnection,), name=f"EmulatorWorker-{workerid}", daemon=True)
+        self.process.start()
+        # Only the worker keeps it's end open, so the pipe breaks when the worker dies
+        workerconnection.close()
+        # The pipe can only have one command in flight, so commands are sent from a single thread
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.dead = False
+
+    # Send a command and wait for the result, blocks the calling thread
+    def callSync(self, command, instanceid, *args):
+        if self.dead:
+            raise EmulatorError(f"{command} failed: worker {self.workerid} stopped")
+        start = time.perf_counter()
+        try:
+            self.connection.send((command, instanceid, args))
+            ok, result, elapsed = self.connection.recv()
+        except (OSError, EOFError):
+            # The worker process died, it's replaced when a new instance is started
+            self.dead = True
+            Metrics.count("worker_deaths")
+            raise EmulatorError(f"{command} failed: worker {self.workerid} stopped")
+        # Time spent running the command in the worker, and the time spent getting it there and back
+        Metrics.observe(command, elapsed)
+        Metrics.observe("worker_ipc", time.perf_counter() - start - elapsed)
+        if not ok:
+            raise EmulatorError(result)
+        return result
+
+    # Send a command without blocking the event loop
+    async def call(self, command, instanceid, *args):
+        queued = time.perf_counter()
+        def run():
+            # Commands wait for the commands of other instances on this worker
+            Metrics.observe("worker_queue", time.perf_counter() - queued)
+            return self.callSync(command, instanceid, *args)
+        return await asyncio.get_event_loop().run_in_executor(self.executor, run)
+
+# Handle to a pyboy instance living in a worker process
+class EmulatorInstance:
+    def __init__(self, worker, instanceid):
+        self.worker = worker
+        self.instanceid = instanceid
+
+    # Press the button for an emoji, and return status text
+    async def action(self, emoji):
+        return await self.worker.call("action", self.instanceid, emoji)
+
+    # Press the buttons for a list of emojis in one go, and return status text
+    async def sequence(self, emojis):
+        return await self.worker.call("sequence", self.instanceid, emojis)
+
+    # Fast-forward a number of seconds without rendering, and return status text
+    async def turbo(self, seconds):
+        return await self.worker.call("turbo", self.instanceid, seconds)
+
+    # Capture the current frame, and return it's fingerprint
+    async def capture(self):
+        return await self.worker.call("capture", self.instanceid)
+
+    # Encode a captured frame, and return the png data
+    async def encode(self, fingerprint):
+        return await self.worker.call("encode", self.instanceid, fingerprint)
+
+    async def stop(self, save=True):
+        self.worker.instancecount -= 1
+        await self.worker.call("stop", self.instanceid, save)
+
+    # Save the state to a file and stop
+    async def hibernate(self, state):
+        self.worker.instancecount -= 1
+        await self.worker.call("hibernate", self.instanceid, state)
+
+    # Save to savepath + ".ram" when stopped, instead of next to the rom the instance was started with
+    async def bind(self, rom, savepath, journal=None):
+        await self.worker.call("bind", self.instanceid, rom, savepath, journal)
+
+# Start the emulator worker processes
+def startEmulatorWorkers():
+    for workerid in range(EmulatorWorkerCount):
+        EmulatorWorkers.append(EmulatorWorker(workerid))
+
+# Pick the worker with the least instances for a new instance
+# Workers that died are replaced first, their instances are lost
+def getEmulatorWorker():
+    for i, worker in enumerate(EmulatorWorkers):
+        if worker.dead or not worker.process.is_alive():
+            print(f"Emulator worker {worker.workerid} stopped, starting a new one")
+            worker.dead = True
+            worker.connection.close()
+            worker.executor.shutdown(wait=False)
+            EmulatorWorkers[i] = EmulatorWorker(worker.workerid)
+    worker = min(EmulatorWorkers, key=lambda worker: worker.instancecount)
+    worker.instancecount += 1
+    return worker, next(InstanceIDs)
+
+# Start a pyboy instance on a worker, and return it's handle
+# Given a state, the instance continues from it instead of booting
+# Given a journal, the instance is restored from it if it exists, and it's inputs are journaled
+async def startEmulator(rom, state=None, journal=None):
+    worker, instanceid = getEmulatorWorker()
     try:
-        # Remove potential previous screenshot
-        os.remove("./ScreenshotResized.png")
+        await worker.call("start", instanceid, rom, state, journal)
     except:
-        pass
-    # Remove possible older leftover screenshots
+        worker.instancecount -= 1
+        raise
+    return EmulatorInstance(worker, instanceid)
+
+# Create the boot snapshots of all roms, spread over the workers
+async def prewarmBootSnapshots():
+    roms = list(RomLocations.values()) + glob.glob("./CustomRoms/*.gb")
+    async def prewarm(worker, roms):
+        for rom in roms:
+            try:
+                await worker.call("prewarm", None, rom)
+            except EmulatorError as e:
+                print(f"Could not create boot snapshot for {rom}: {e}")
+    await asyncio.gather(*[prewarm(worker, roms[i::len(EmulatorWorkers)]) for i, worker in enumerate(EmulatorWorkers)])
+
+# Boot the global game, if it's not started by a PA!Join yet
+async def startGlobalGame():
+    start = time.perf_counter()
     try:
-        [os.remove("./screenshots/" + file) for file in os.listdir("./screenshots/")]
-    except:
-        pass
-    # Screenshot pyboy instance
-    pyboy.send_input(WindowEvent.SCREENSHOT_RECORD)
-    pyboy.tick()
-    # Open the image
-    img = Image.open(f"./screenshots/{os.listdir('./screenshots/')[0]}")
-    # Resize 3x, nearest neighbor
-    img = img.resize((img.size[0] * 3, img.size[1] * 3), 0)
-    img.save("ScreenshotResized.png")
-    # Return the screenshot path.
-    return "ScreenshotResized.png"
+        await getInstance(GlobalSession)
+    except EmulatorError as e:
+        print(f"Could not start the global game: {e}")
+        return
+    print(f"Global game started in {time.perf_counter() - start:.2f}s")
+    Metrics.observe("startup_global_game", time.perf_counter() - start)
+
+# Link a rom to a path, so the emulator saves next to the link instead of the rom
+def linkRom(rom, romlink):
+    if os.path.lexists(romlink):
+        os.remove(romlink)
+    os.symlink(os.path.abspath(rom), romlink)
+
+# Warm pool
+# Booting a game takes a while, so a few instances of every rom in RomLocations are kept booted
+# A new single player game without a save claims one, and the pool is refilled in the background
+class WarmPool:
+    def __init__(self, size, idletime):
+        self.size = size
+        self.idletime = idletime
+        # Rom to the ready instances, with the rom link they run on
+        self.instances = {}
+        self.filling = set()
+        self.lastclaim = {}
+        self.linkids = itertools.count()
+
+    # Returns a booted instance saving to romlink, or None if there's none ready
+    async def claim(self, rom, romlink, journal=None):
+        # Pool instances have no save, games with a save have to boot with it
+        if self.size == 0 or rom not in RomLocations.values() or os.path.exists(romlink + ".ram"):
+            return None
+        start = time.perf_counter()
+        self.lastclaim[rom] = time.monotonic()
+        instances = self.instances.get(rom)
+        instance = None
+        while instances and instance is None:
+            instance, poollink = instances.pop()
+            try:
+                await instance.bind(poollink, romlink, journal)
+            except EmulatorError as e:
+                print(f"Could not claim a warm pool instance of {rom}: {e}")
+                instance = None
+            # The rom is already loaded, so the link is removed here, even if the instance dies with it's worker
+            if os.path.lexists(poollink):
+                os.remove(poollink)
+        self.fill(rom)
+        if instance is None:
+            Metrics.count("warmpool_misses")
+            return None
+        Metrics.count("warmpool_hits")
+        Metrics.observe("warmpool_claim", time.perf_counter() - start)
+        return instance
+
+    # Refill the pool of a rom in the background
+    def fill(self, rom):
+        if rom not in self.filling:
+            self.filling.add(rom)
+            asyncio.ensure_future(self.runFill(rom))
+
+    async def runFill(self, rom):
+        try:
+            instances = self.instances.setdefault(rom, [])
+            while len(instances) < self.size and time.monotonic() - self.lastclaim.get(rom, 0) < self.idletime:
+                poollink = f"./SinglePlayerSaves/pool-{next(self.linkids)}.gb"
+                linkRom(rom, poollink)
+                try:
+                    instances.append((await startEmulator(poollink), poollink))
+                except EmulatorError as e:
+                    print(f"Could not fill the warm pool of {rom}: {e}")
+                    os.remove(poollink)
+                    break
+        finally:
+            self.filling.discard(rom)
+
+    # Stop the ready instances of roms that weren't claimed for a while
+    async def shrink(self):
+        for rom, instances in list(self.instances.items()):
+            if time.monotonic() - self.lastclaim.get(rom, 0) < self.idletime:
+                continue
+            while instances:
+                instance, poollink = instances.pop()
+                try:
+                    await instance.stop(save=False)
+                except EmulatorError:
+                    pass
+                os.remove(poollink)
+
+    def getReadyCount(self):
+        return sum(len(instances) for instances in self.instances.values())
+
+    # Remove links left behind by an earlier run, also when the pool is disabled
+    def removeLinks(self):
+        for path in glob.glob("./SinglePlayerSaves/pool-*"):
+            os.remove(path)
+
+    async def run(self):
+        for rom in set(RomLocations.values()):
+            self.lastclaim[rom] = time.monotonic()
+            self.fill(rom)
+        while True:
+            await asyncio.sleep(60)
+            await self.shrink()
+
+Pool = WarmPool(WarmPoolSize, WarmPoolIdleTime)
+
+# Outbound discord requests
+# Work on different messages runs concurrently, work on the same message runs in order
+# A pending edit is replaced by a newer one, so only the newest embed is sent
+# Reaction removals wait untill no message work is left, or they have waited for too long
+class OutboundScheduler:
+    def __init__(self, concurrency):
+        self.concurrency = concurrency
+        self.semaphore = None
+        # Message id to it's pending work
+        self.pending = {}
+        # (message id, emoji, user id) to pending reaction removals
+        self.removals = collections.OrderedDict()
+        self.removing = False
+
+    def getPending(self, message):
+        if message.id not in self.pending:
+            self.pending[message.id] = {"message": message, "edit": None, "clear": False, "reactions": []}
+            asyncio.ensure_future(self.runMessage(message.id))
+        return self.pending[message.id]
+
+    # Edit a message, and remove it's reactions after if clear is set
+    def edit(self, message, embed, clear=False):
+        pending = self.getPending(message)
+        pending["edit"] = embed
+        if clear:
+            pending["clear"] = True
+            pending["reactions"] = []
+
+    def addReactions(self, message, emojis):
+        self.getPending(message)["reactions"].extend(emojis)
+
+    def removeReaction(self, message, emoji, member):
+        self.removals[(message.id, str(emoji), member.id)] = (message, emoji, member, time.monotonic())
+        self.startRemovals()
+
+    # Removals can be postponed, but a user can't use a reaction again untill it's removed
+    def canRemove(self):
+        return self.removals and (not self.pending or time.monotonic() - next(iter(self.removals.values()))[3] > 2)
+
+    async def request(self, coroutine, stage="discord_request"):
+        # The semaphore is made here, so it belongs to the running event loop
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            start = time.perf_counter()
+            try:
+                await coroutine
+            except:
+                Metrics.count("discord_errors")
+            Metrics.observe(stage, time.perf_counter() - start)
+
+    async def runMessage(self, messageid):
+        pending = self.pending[messageid]
+        message = pending["message"]
+        try:
+            while True:
+                if pending["edit"] is not None:
+                    embed = pending["edit"]
+                    pending["edit"] = None
+                    await self.request(message.edit(embed=embed), "discord_edit")
+                elif pending["clear"]:
+                    pending["clear"] = False
+                    await self.request(message.clear_reactions())
+                elif pending["reactions"]:
+                    # Newer edits go before the remaining reactions
+                    await self.request(message.add_reaction(pending["reactions"].pop(0)))
+                else:
+                    break
+        finally:
+            self.pending.pop(messageid)
+            self.startRemovals()
+
+    def startRemovals(self):
+        if self.canRemove() and not self.removing:
+            self.removing = True
+            asyncio.ensure_future(self.runRemovals())
+
+    async def runRemovals(self):
+        try:
+            while self.canRemove():
+                message, emoji, member, queued = self.removals.popitem(last=False)[1]
+                await self.request(message.remove_reaction(emoji, member))
+        finally:
+            self.removing = False
+            # Removals left over are picked up when the pending message work is done
+            self.startRemovals()
+
+Outbound = OutboundScheduler(OutboundConcurrency)
+
+Metrics.gauge("sessions", lambda: len(ChannelInfo.sessions))
+Metrics.gauge("viewers", lambda: len(ChannelInfo.channels))
+Metrics.gauge("hibernating_sessions", lambda: sum(session.type == "single" and session.instance is None for session in ChannelInfo.sessions.values()))
+Metrics.gauge("emulator_instances", lambda: sum(worker.instancecount for worker in EmulatorWorkers))
+Metrics.gauge("warmpool_ready", Pool.getReadyCount)
+Metrics.gauge("warmpool_hitrate", lambda: round(Metrics.counters["warmpool_hits"] / max(1, Metrics.counters["warmpool_hits"] + Metrics.counters["warmpool_misses"]), 3))
+Metrics.gauge("screenshot_cache_memory", lambda: len(ScreenshotCache.memory))
+Metrics.gauge("outbound_pending", lambda: len(Outbound.pending) + len(Outbound.removals))
+
+# Screenshot uploads
+# Frames missing from the cache are collected for a short window, and sent to the image channel together
+# A message holds up to 10 attachments, a frame that is already waiting or being sent is only sent once
+class UploadBatcher:
+    def __init__(self, window, maxfiles=10):
+        self.window = window
+        self.maxfiles = maxfiles
+        # Fingerprint to the frame data and the future of it's url, for frames waiting to be sent
+        self.pending = {}
+        # Fingerprint to the future of it's url, for frames being sent
+        self.sending = {}
+        self.timer = None
+
+    # Returns the url of an uploaded frame, or "" if the upload failed
+    async def upload(self, fingerprint, data):
+        if fingerprint in self.sending:
+            return await asyncio.shield(self.sending[fingerprint])
+        if fingerprint in self.pending:
+            return await asyncio.shield(self.pending[fingerprint][1])
+        future = asyncio.get_event_loop().create_future()
+        self.pending[fingerprint] = (data, future)
+        if len(self.pending) >= self.maxfiles:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_event_loop().call_later(self.window, self.flush)
+        return await asyncio.shield(future)
+
+    # Send the waiting frames, in messages of up to maxfiles attachments
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.pending:
+            batch = []
+            while self.pending and len(batch) < self.maxfiles:
+                fingerprint = next(iter(self.pending))
+                data, future = self.pending.pop(fingerprint)
+                self.sending[fingerprint] = future
+                batch.append((fingerprint, data, future))
+            asyncio.ensure_future(self.send(batch))
+
+    async def send(self, batch):
+        global ImageChannelID
+        global ScreenshotCache
+        start = time.perf_counter()
+        try:
+            # Send the images
+            msg = await client.get_channel(ImageChannelID).send("", files=[discord.File(io.BytesIO(data), filename=f"{fingerprint}.{FrameFormat}") for fingerprint, data, future in batch])
+            # Match attachments by filename, never by position, so a session can't get another frame
+            urls = {attachment.filename: attachment.url for attachment in msg.attachments}
+        except:
+            Metrics.count("upload_failures")
+            urls = {}
+        else:
+            Metrics.observe("upload", time.perf_counter() - start)
+            Metrics.count("upload_messages")
+        for fingerprint, data, future in batch:
+            url = urls.get(f"{fingerprint}.{FrameFormat}", "")
+            try:
+                if url:
+                    Metrics.count("uploads")
+                    Metrics.count("upload_bytes", len(data))
+                    # Add the image to cache, a cache error only loses the cache entry
+                    try:
+                        ScreenshotCache.put(fingerprint, url)
+                    except Exception as e:
+                        print(f"Could not cache screenshot url: {e!r}")
+            finally:
+                # Every waiting upload must get a result, or it's session never continues
+                self.sending.pop(fingerprint, None)
+                if not future.done():
+                    future.set_result(url)
+
+Uploads = UploadBatcher(UploadBatchWindow)
 
 # Upload a screenshot to discord for embedding
-async def uploadScreenshot(fp):
-    global ImageChannelID
-    global ScreenshotCache
-    if fp == "":
+async def uploadScreenshot(fingerprint, data):
+    if not data:
         return ""
-    # Hash the screenshot
-    with open(fp,"rb") as f:
-        dump = f.read()
-        readable_hash = hashlib.sha512(dump).hexdigest()
-    # Check if we've seen this screenshot before
-    if readable_hash in ScreenshotCache.keys():
-        # File was found in cache
-        url = ScreenshotCache[readable_hash]
+    return await Uploads.upload(fingerprint, data)
+
+# Hibernation
+# Idle single player games are saved to disk and their emulator is stopped, only the session is kept
+# The emulator is started again as soon as the game is used
+
+# Returns the emulator of a session, resuming it if it's hibernating
+async def getInstance(session):
+    session.lastactive = time.monotonic()
+    if session.instance is None or session.instance.worker.dead:
+        async with getStateLock(session):
+            # A game on a worker that died continues from it's journal
+            if session.instance is None or session.instance.worker.dead:
+                await resumeSession(session)
+    return session.instance
+
+# Run a command on the emulator of a session
+# If the worker died during the command, the game continues from it's journal and the command is run once more
+async def runOnInstance(session, command):
+    instance = await getInstance(session)
+    try:
+        return await command(instance)
+    except EmulatorError:
+        if not instance.worker.dead:
+            raise
+    Metrics.count("worker_retries")
+    return await command(await getInstance(session))
+
+# Start the emulator of a session that is hibernating, restored after a restart, or not started yet
+# Hibernating removes the journal, so a journal is always newer than a hibernated state
+async def resumeSession(session):
+    journal = session.journalpath
+    state = None
+    if os.path.exists(session.hibernatepath) and not (journal is not None and os.path.exists(journal)):
+        state = session.hibernatepath
+    session.instance = await startEmulator(session.filepath, state, journal)
+    if os.path.exists(session.hibernatepath):
+        os.remove(session.hibernatepath)
+
+def getStateLock(session):
+    # The lock is made here, so it belongs to the running event loop
+    if session.statelock is None:
+        session.statelock = asyncio.Lock()
+    return session.statelock
+
+async def hibernateSession(session):
+    async with getStateLock(session):
+        if session.instance is None or time.monotonic() - session.lastactive < HibernateAfter:
+            return
+        # A game on a worker that died can't be hibernated, it's resumed from it's journal when it's used
+        if session.instance.worker.dead:
+            session.instance = None
+            return
+        # Clear the instance first, so anything that wants to use it waits for the game to resume
+        instance = session.instance
+        session.instance = None
+        try:
+            await instance.hibernate(session.hibernatepath)
+        except EmulatorError as e:
+            print(f"Could not hibernate session {session.sessionid}: {e}")
+            session.instance = instance
+
+# Stop the emulator of a session, saving the game
+async def stopSession(session):
+    async with getStateLock(session):
+        if session.instance is not None and session.instance.worker.dead:
+            session.instance = None
+        # A game restored after a restart, or on a worker that died, is resumed so the inputs in it's journal are saved
+        if session.instance is None and session.journalpath is not None and os.path.exists(session.journalpath):
+            await resumeSession(session)
+        if session.instance is not None:
+            try:
+                await session.instance.stop(save=True)
+            except EmulatorError:
+                if not session.instance.worker.dead:
+                    raise
+                # The worker died before the game was saved, save it from it's journal instead
+                await resumeSession(session)
+                await session.instance.stop(save=True)
+            session.instance = None
+        # A hibernating game was already saved
+        elif os.path.exists(session.hibernatepath):
+            os.remove(session.hibernatepath)
+
+# Hibernate idle single player games every minute
+async def hibernateIdleSessions():
+    while True:
+        await asyncio.sleep(60)
+        for session in list(ChannelInfo.sessions.values()):
+            if session.type == "single" and session.instance is not None and time.monotonic() - session.lastactive >= HibernateAfter:
+                await hibernateSession(session)
+
+# Inactivity expiry
+# Single player games and channels watching the global game are kicked after 30 minutes without input
+# They are filed in a wheel by the second they expire, and a single task reaps them every second
+# Activity only moves removecounter forward, an entry that was active is filed again when it's old second comes up
+class ExpiryWheel:
+    def __init__(self, handler):
+        self.handler = handler
+        # Second to the entries expiring in it
+        self.slots = collections.defaultdict(list)
+        self.count = 0
+        self.lasttick = int(datetime.datetime.now().timestamp())
+
+    # Add a session or viewer, it expires at it's removecounter
+    def add(self, entry):
+        self.slots[max(entry.removecounter, self.lasttick + 1)].append(entry)
+        self.count += 1
+
+    # Keep a session or viewer for another 30 minutes
+    def touch(self, entry):
+        entry.removecounter = max(int(datetime.datetime.now().timestamp()) + 1800, entry.removecounter)
+
+    # Returns the entries expired by now
+    def getExpired(self, now):
+        expired = []
+        while self.lasttick < now:
+            self.lasttick += 1
+            for entry in self.slots.pop(self.lasttick, ()):
+                if entry.removecounter > now:
+                    self.slots[entry.removecounter].append(entry)
+                else:
+                    expired.append(entry)
+        self.count -= len(expired)
+        return expired
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(1)
+            expired = self.getExpired(int(datetime.datetime.now().timestamp()))
+            if expired:
+                # This is the only task kicking inactive games, so a failing batch must not stop it
+                try:
+                    await self.handler(expired)
+                except Exception as e:
+                    print(f"Could not expire {len(expired)} inactive games: {e!r}")
+
+# Kick expired sessions and viewers, the games are saved and stopped together
+async def expireInactive(entries):
+    stopping = []
+    for entry in entries:
+        if isinstance(entry, Session):
+            # The game could have been stopped with PA!Leave in the meantime
+            if ChannelInfo.getSession(entry.sessionid) is not entry:
+                continue
+            for viewer in ChannelInfo.removeSession(entry):
+                Outbound.edit(viewer.message, GetEmbed("Kicked due to inactivity!"), clear=True)
+            stopping.append(entry)
+        else:
+            # The channel could have left with PA!Leave in the meantime
+            if ChannelInfo.get(entry.channelid) is not entry:
+                continue
+            ChannelInfo.removeViewer(entry)
+            Outbound.edit(entry.message, GetEmbed("Kicked due to inactivity!"), clear=True)
+        Metrics.count("inactivity_kicks")
+    for session, result in zip(stopping, await asyncio.gather(*[stopSession(session) for session in stopping], return_exceptions=True)):
+        if isinstance(result, Exception):
+            print(f"Could not stop session {session.sessionid}: {result!r}")
+
+Expiry = ExpiryWheel(expireInactive)
+Metrics.gauge("expiry_entries", lambda: Expiry.count)
+
+# Restore the sessions and viewers that were running when the bot stopped
+# Games are resumed from their journal when they're first used, like hibernating games
+async def restoreSessions():
+    manifests = []
+    for path in glob.glob("./Sessions/*.json"):
+        try:
+            with open(path, "r") as f:
+                manifests.append(json.loads(f.read()))
+        except (OSError, ValueError) as e:
+            print(f"Could not read session {path}: {e}")
+    # Journals of games that never got a manifest
+    for path in glob.glob("./Sessions/*.journal"):
+        sessionid = os.path.basename(path)[:-len(".journal")]
+        if sessionid != "global" and not any(manifest["sessionid"] == sessionid for manifest in manifests):
+            os.remove(path)
+
+    async def fetchMessage(channelid, messageid):
+        try:
+            return await client.get_channel(channelid).fetch_message(messageid)
+        except:
+            return None
+
+    async def restore(manifest):
+        if manifest["type"] == "global":
+            session = GlobalSession
+        else:
+            session = Session("single", None, manifest["permanent"], manifest["filepath"], manifest["sessionid"], manifest["refer"])
+        messages = await asyncio.gather(*[fetchMessage(channelid, messageid) for channelid, messageid in manifest["viewers"]])
+        viewers = [(channelid, message) for (channelid, messageid), message in zip(manifest["viewers"], messages) if message is not None and channelid not in ChannelInfo]
+        # A single player game can't continue without the channel hosting it, it's saved and stopped
+        if session is not GlobalSession and session.refer not in [channelid for channelid, message in viewers]:
+            os.remove(session.manifestpath)
+            await stopSession(session)
+            return 0
+        if session is not GlobalSession:
+            ChannelInfo.addSession(session)
+            if not session.permanent:
+                Expiry.add(session)
+        for channelid, message in viewers:
+            viewer = ChannelInfo.addViewer(session, channelid, message)
+            if session is GlobalSession:
+                Expiry.add(viewer)
+        return 1
+
+    results = await asyncio.gather(*[restore(manifest) for manifest in manifests], return_exceptions=True)
+    for manifest, result in zip(manifests, results):
+        if isinstance(result, Exception):
+            print(f"Could not restore session {manifest['sessionid']}: {result!r}")
+    if manifests:
+        print(f"Restored {sum(result == 1 for result in results)} of {len(manifests)} sessions")
+
+# Run single player inputs on a session, and show the result
+# Inputs that arrive while a sequence is running are all run as the next sequence
+async def runInputs(session, emojis):
+    if not session.inputs:
+        session.inputtime = time.perf_counter()
+    session.inputs.extend(emojis)
+    if session.inputting:
+        return
+    session.inputting = True
+    try:
+        if InputBatchWindow > 0:
+            await asyncio.sleep(InputBatchWindow)
+        while session.inputs and ChannelInfo.getSession(session.sessionid) is session:
+            emojis = session.inputs[:MaxInputSequence]
+            session.inputs = session.inputs[MaxInputSequence:]
+            inputtime = session.inputtime
+            channels = list(session.viewers.values())
+            try:
+                if len(emojis) == 1:
+                    EmbedText = await runOnInstance(session, lambda instance: instance.action(emojis[0]))
+                else:
+                    EmbedText = await runOnInstance(session, lambda instance: instance.sequence(emojis))
+                # Only the last frame is rendered, and only shown if it changed
+                await runOnInstance(session, lambda instance: refreshFrame(instance, channels))
+            except EmulatorError as e:
+                print(f"Could not run inputs on session {session.sessionid}: {e}")
+                for channel in channels:
+                    Outbound.edit(channel.message, GetEmbed("The game could not be run, please try again!").set_image(url=channel.image))
+                continue
+            for channel in channels:
+                Outbound.edit(channel.message, GetEmbed(EmbedText).set_image(url=channel.image))
+            Metrics.observe("press_to_frame", time.perf_counter() - inputtime)
+    finally:
+        session.inputting = False
+
+# Make sure the channels have the current frame of an instance as their image
+# Frames that are already shown are not looked up, and cached frames are never encoded
+async def refreshFrame(instance, channels):
+    fingerprint = await instance.capture()
+    url = None
+    for viewer in channels:
+        if viewer.frame == fingerprint:
+            continue
+        if url is None:
+            # Check if we've seen this frame before
+            url = ScreenshotCache.get(fingerprint)
+            Metrics.count("cache_hits" if url is not None else "cache_misses")
+            if url is None:
+                # The frame was not found in cache
+                url = await uploadScreenshot(fingerprint, await instance.encode(fingerprint))
+        # Failed uploads are retried on the next refresh
+        if url:
+            viewer.frame = fingerprint
+            viewer.image = url
+
+
+# Custom rom ingestion
+# Uploaded roms are streamed to a temporary file while they are hashed, then moved to their ID
+class CustomRomError(Exception):
+    pass
+
+# Roms are stored one at a time, so the index is never written twice at once
+CustomRomExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+# Custom rom ID to it's metadata, so starting a custom game doesn't need to read the rom
+if os.path.exists("./CustomRoms/index.json"):
+    with open("./CustomRoms/index.json", "r") as f:
+        CustomRomIndex = json.loads(f.read())
+else:
+    CustomRomIndex = {}
+
+# Check the header of a rom, and return it's metadata
+def readRomHeader(header):
+    if len(header) < 0x150:
+        raise CustomRomError("That is not a gameboy rom!")
+    # Check if the cartride nintendo logo is the same as the official logo
+    # This is literally Nintendo's DRM
+    if header[0x104:0x134] != bytes.fromhex(NintendoLogo):
+        raise CustomRomError("That is not a gameboy rom!\nIf this is a Gameboy rom, and it plays correctly on an emulator, please join the support server and ask for help.")
+    # The Game Boy refuses to boot a cartridge with a wrong header checksum
+    checksum = 0
+    for byte in header[0x134:0x14D]:
+        checksum = (checksum - byte - 1) & 0xFF
+    if checksum != header[0x14D]:
+        raise CustomRomError("That gameboy rom is damaged! (Wrong header checksum)")
+    return {"title": header[0x134:0x144].split(b"\0")[0].decode("ascii", "replace").strip(), "cartridgetype": header[0x147], "romsize": 0x8000 << header[0x148]}
+
+# Write a chunk to the temporary file and hash it, runs in a thread
+def writeRomChunk(f, hash, chunk):
+    f.write(chunk)
+    hash.update(chunk)
+
+# Move a hashed rom to it's ID, and add it to the index, runs in a thread
+def storeCustomRom(temporary, romid, metadata):
+    if os.path.exists(f"./CustomRoms/{romid}.gb"):
+        # The same rom was uploaded before
+        if CustomRomIndex.get(romid, metadata)["md5"] != metadata["md5"]:
+            raise CustomRomError("This rom's ID is already used by a different rom, please join the support server and ask for help.")
+        os.remove(temporary)
     else:
+        os.replace(temporary, f"./CustomRoms/{romid}.gb")
+    CustomRomIndex[romid] = metadata
+    with open("./CustomRoms/index.json.tmp", "w") as f:
+        f.write(json.dumps(CustomRomIndex))
+    os.replace("./CustomRoms/index.json.tmp", "./CustomRoms/index.json")
+
+# Download, check and store a custom rom attachment, and return it's ID
+async def ingestCustomRom(attachment):
+    if attachment.size > MaxCustomRomSize:
+        raise CustomRomError("That rom is too big!")
+    loop = asyncio.get_event_loop()
+    hash = hashlib.md5()
+    header = b""
+    size = 0
+    descriptor, temporary = tempfile.mkstemp(dir="./CustomRoms", suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "wb") as f:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(attachment.url) as response:
+                    if response.status != 200:
+                        raise CustomRomError("Could not download the rom, please try again!")
+                    async for chunk in response.content.iter_chunked(65536):
+                        size += len(chunk)
+                        if size > MaxCustomRomSize:
+                            raise CustomRomError("That rom is too big!")
+                        # The header is checked as soon as it's downloaded
+                        if len(header) < 0x150:
+                            header += chunk[:0x150 - len(header)]
+                            if len(header) == 0x150:
+                                metadata = readRomHeader(header)
+                        await loop.run_in_executor(None, writeRomChunk, f, hash, chunk)
+        if len(header) < 0x150:
+            readRomHeader(header)
+        metadata["size"] = size
+        metadata["md5"] = hash.hexdigest()
+        romid = metadata["md5"][0:5]
+        await loop.run_in_executor(CustomRomExecutor, storeCustomRom, temporary, romid, metadata)
+    # A download that times out raises asyncio.TimeoutError, which is not a ClientError
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        raise CustomRomError("Could not download the rom, please try again!")
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return romid
+
+
+# Returns if a user is one of the bot's admins, from AdminIDs or the owner of the bot application
+async def isBotAdmin(user):
+    global ApplicationOwnerID
+    if user.id in AdminIDs:
+        return True
+    if ApplicationOwnerID is None:
         try:
-            # The image was not found in cache
-            # Send the image
-            msg = await client.get_channel(ImageChannelID).send("", file=discord.File(fp, filename=readable_hash[10:] + ".png"))
-            url = msg.attachments[0].url
-            # Add the image to cache
-            ScreenshotCache[readable_hash] = url
-            with open("ScreenshotCache.json", "w") as f:
-                f.write(json.dumps(ScreenshotCache))
+            ApplicationOwnerID = (await client.application_info()).owner.id
         except:
-            return ""
-    return url
+            return False
+    return user.id == ApplicationOwnerID
 
+ApplicationOwnerID = None
 
 class MyClient(discord.Client):
 
     async def on_ready(self):
         print("Logged in as", str(client.user))
+        if "connect" not in StartupPhases:
+            endStartupPhase("connect")
+            print("Online in " + f"{sum(StartupPhases.values()):.2f}s (" + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in StartupPhases.items()) + ")")
+            for name, seconds in StartupPhases.items():
+                Metrics.observe("startup_" + name.replace(" ", "_"), seconds)
         # Playing Pokemon | PA!Help
         # Easy for users to understand what's going on, and help command
         await client.change_presence(activity=discord.Game(name=f"Pokémon | PA!Help"))
+        # on_ready also runs after reconnecting, only start background work once
+        if getattr(self, "started", False):
+            return
+        self.started = True
+        if CheckpointInterval > 0:
+            await restoreSessions()
+        if BootGlobalGame:
+            asyncio.ensure_future(startGlobalGame())
+        if HibernateAfter > 0:
+            asyncio.ensure_future(hibernateIdleSessions())
+        asyncio.ensure_future(Expiry.run())
+        Pool.removeLinks()
+        if WarmPoolSize > 0:
+            asyncio.ensure_future(Pool.run())
+        if MetricsFile and MetricsInterval > 0:
+            asyncio.ensure_future(Metrics.run(MetricsFile, MetricsInterval))
+        if PrewarmBootSnapshots:
+            await prewarmBootSnapshots()
 
     async def on_message(self, message):
         global ChannelInfo
-        global NintendoLogo
         global RomLocations
         # Don't respond to bots
         if message.author.bot:
@@ -194,7 +1642,7 @@ class MyClient(discord.Client):
                     pass
             try:
                 # Try to send embed
-                await message.channel.send("", embed=GetEmbed(f"Pokémon Arcade is a Discord bot to play pokemon on Discord!\nPlay by voting on which action to take, or play your own way in singleplayer!\n\nCommands List:\n`PA!Join (Session ID)`: Joins a game\n`PA!Leave`: Leaves or stops the game\n`PA!Singleplayer`: Start a private game\n`PA!Singleplayer (yellow|blue|custom) (permanent)`: Start a different Pokémon game\n\nUse the reactions to interact\n:a: :b: :arrow_left: :arrow_up: :arrow_down: :arrow_right: - Press buttons\n:arrow_forward: - Start\n:blue_square: - Select\n:clock1: - Wait 2 in-game seconds\n\n[Support Server]({SupportServerURL})"))
+                await message.channel.send("", embed=GetEmbed(f"Pokémon Arcade is a Discord bot to play pokemon on Discord!\nPlay by voting on which action to take, or play your own way in singleplayer!\n\nCommands List:\n`PA!Join (Session ID)`: Joins a game\n`PA!Leave`: Leaves or stops the game\n`PA!Singleplayer`: Start a private game\n`PA!Singleplayer (yellow|blue|custom) (permanent)`: Start a different Pokémon game\n`PA!Do (inputs)`: Press a sequence of buttons when playing alone, like `PA!Do up*5 a`\n`PA!Turbo (seconds)`: Fast-forward the game when playing alone\n\nUse the reactions to interact\n:a: :b: :arrow_left: :arrow_up: :arrow_down: :arrow_right: - Press buttons\n:arrow_forward: - Start\n:blue_square: - Select\n:clock1: - Wait 2 in-game seconds\n\n[Support Server]({SupportServerURL})"))
             except discord.errors.Forbidden:
                 try:
                     # If sending embed failed, send this
@@ -208,77 +1656,47 @@ class MyClient(discord.Client):
 
         if message.content.lower().startswith("pa!join"):
             # If there's already a game in the channel
-            if message.channel.id in ChannelInfo.keys():
+            if message.channel.id in ChannelInfo:
                 await message.channel.send("Only one game per channel!", delete_after=20)
                 return
             # If a game code has been given
             if len(message.content.lower().split(" ")) > 1:
-                # Try to get the channel with the correct sessionid
-                referchannel = {}
-                for channel in list(ChannelInfo.keys()):
-                    channel = ChannelInfo[channel]
-                    # Find any channel with the same session ID
-                    if channel["sessionid"] == message.content.lower().split(" ")[1]:
-                        # Set the referchannel, to be sure that we have the right starting channel for playercount
-                        gametype = "single"
-                        referchannel = ChannelInfo[channel["refer"]]
-                        referchannelid = channel["refer"]
-                        ChannelInfo[referchannelid]["playercount"] += 1
-                        pyboy = referchannel["instance"]
-                        permanent = referchannel["permanent"]
-                        romlink = referchannel["filepath"]
-                        sessionid = referchannel["sessionid"]
-                        break
-                # If no channel with that session id was found
-                if referchannel == {}:
+                # Get the session with that session ID
+                session = ChannelInfo.getSession(message.content.lower().split(" ")[1])
+                # If no session with that session id was found
+                if session is None:
                     await message.channel.send("Invalid Session ID!")
                     return
             else:
-                gametype = "global"
-                referchannel = ChannelInfo["global"]
-                referchannelid = "global"
-                ChannelInfo[referchannelid]["playercount"] += 1
-                pyboy = referchannel["instance"]
-                permanent = False
-                romlink = referchannel["filepath"]
-                sessionid = referchannel["sessionid"]
+                session = GlobalSession
             # Send the update message
-            UpdateMessage = await message.channel.send("", embed=GetEmbed(f"Displaying Game!").set_image(url=await uploadScreenshot(screenshot(pyboy))))
-            # Add the pyboy instance to the list
-            ChannelInfo[message.channel.id] = {"type": gametype, "instance": pyboy, "message": UpdateMessage, "removecounter": int(datetime.datetime.now().timestamp()) + 1800, "permanent": permanent, "filepath": romlink, "sessionid": sessionid, "refer": referchannelid, "playercount": 1}
+            frame = Viewer(message.channel.id, session, None, None, "")
+            try:
+                await runOnInstance(session, lambda instance: refreshFrame(instance, [frame]))
+            except EmulatorError as e:
+                print(f"Could not show session {session.sessionid}: {e}")
+                await message.channel.send("The game could not be started, please try again!", delete_after=20)
+                return
+            UpdateMessage = await message.channel.send("", embed=GetEmbed(f"Displaying Game!").set_image(url=frame.image))
+            # The session could have stopped while the message was sent
+            if ChannelInfo.getSession(session.sessionid) is not session:
+                Outbound.edit(UpdateMessage, GetEmbed("Game host stopped playing!"))
+                return
+            # Add the channel to the session
+            viewer = ChannelInfo.addViewer(session, message.channel.id, UpdateMessage, frame.frame, frame.image)
             # Add all control reactions
-            for emoji in list("🅰🅱⬅⬆⬇➡▶🟦🕐"):
-                await ChannelInfo[message.channel.id]["message"].add_reaction(emoji)
+            Outbound.addReactions(UpdateMessage, list("🅰🅱⬅⬆⬇➡▶🟦🕐"))
 
-            if referchannelid == "global":
-                # Get the current timestamp
-                timenowunix = int(datetime.datetime.now().timestamp())
-                try:
-                    # While the set "go inactive" time is later than right now
-                    while ChannelInfo[message.channel.id]["removecounter"] > timenowunix:
-                        # Sleep untill the player should be kicked for inactivity if they don't press any buttons
-                        await asyncio.sleep(ChannelInfo[message.channel.id]["removecounter"] - timenowunix + 1)
-                        # Reset current time
-                        timenowunix = int(datetime.datetime.now().timestamp())
-                except KeyError:
-                    # We except KeyError here because it's possible that ChannelInfo[message.channel.id] has been removed by PA!Leave
-                    return
-                # Leaves the current game
-                info = ChannelInfo[message.channel.id]
-                info["instance"].stop(save=True)
-                try:
-                    await info["message"].edit(embed=GetEmbed("Kicked due to inactivity!"))
-                    await info["message"].clear_reactions()
-                except:
-                    pass
-                ChannelInfo.pop(message.channel.id)
+            # Channels watching the global game are kicked for inactivity, the global game itself keeps running
+            if session is GlobalSession:
+                Expiry.add(viewer)
 
         if message.content.lower().startswith("pa!singleplayer"):
             if sys.platform == "win32":
                 await message.channel.send("Singleplayer games are disabled!")
                 return
             # If there's already a game in the channel
-            if message.channel.id in ChannelInfo.keys():
+            if message.channel.id in ChannelInfo:
                 await message.channel.send("Only one game per channel!", delete_after=20)
                 return
             # Set permanent to avoid unset variable
@@ -315,8 +1733,8 @@ class MyClient(discord.Client):
                         if len(splitcontent[2]) != 5:
                             await message.channel.send("That's not a valid Game ID!")
                             return
-                        # If the path exists
-                        if os.path.isfile(f"./CustomRoms/{splitcontent[2]}.gb"):
+                        # If the rom exists
+                        if splitcontent[2] in CustomRomIndex or os.path.isfile(f"./CustomRoms/{splitcontent[2]}.gb"):
                             # Set the rom to the custom one
                             rom = f"./CustomRoms/{splitcontent[2]}.gb"
                             romlink = f"./SinglePlayerSaves/pokemon{splitcontent[2]}-{str(message.channel.id)}.gb"
@@ -329,26 +1747,13 @@ class MyClient(discord.Client):
                         if not message.attachments[0].filename.endswith(".gb"):
                             await message.channel.send("That is not a gameboy rom!")
                             return
-                        # Download the attachment, not as the user submitted filename
-                        await message.attachments[0].save(f"./NotHashed.gb")
-                        # Hash the attachment
-                        with open("./NotHashed.gb","rb") as f:
-                            dump = f.read()
-                            NintendoLogoCart = ""
-                            for i in range(0x0104, 0x0134):
-                                hexval = hex(int(dump[i])).split("x")[1].upper()
-                                NintendoLogoCart += ("0" * (2 - len(hexval))) + hexval
-                            readable_hash = hashlib.md5(dump).hexdigest()
-                            readable_hash = readable_hash[0:5]
-                        # Check if the cartride nintendo logo is the same as the official logo
-                        # This is literally Nintendo's DRM
-                        if NintendoLogo != NintendoLogoCart:
-                            await message.channel.send("That is not a gameboy rom!\nIf this is a Gameboy rom, and it plays correctly on an emulator, please join the support server and ask for help.")
-                            os.remove("./NotHashed.gb")
-                            return
-                        # Move the attachment to a set location by it's hash
+                        # Download and check the attachment, it's stored by it's hash
                         # This is required for custom rom saves, and replaying games by ID
-                        os.system(f"mv ./NotHashed.gb ./CustomRoms/{readable_hash}.gb")
+                        try:
+                            readable_hash = await ingestCustomRom(message.attachments[0])
+                        except CustomRomError as e:
+                            await message.channel.send(str(e))
+                            return
                         rom = f"./CustomRoms/{readable_hash}.gb"
                         romlink = f"./SinglePlayerSaves/{readable_hash}-{str(message.channel.id)}.gb"
                         # Send the hash back to the uploader
@@ -363,143 +1768,156 @@ class MyClient(discord.Client):
                     return
 
             # Get the session id
-            sessionid = hashlib.md5(bytes(str(message.channel.id) + str(int(datetime.datetime.now().timestamp())), "utf-8")).hexdigest()[:5]
+            # Session ids are short, so a new one is picked untill it isn't used by a running or restorable game
+            # The session id also names the game's journal and manifest
+            for attempt in itertools.count():
+                sessionid = hashlib.md5(bytes(str(message.channel.id) + str(int(datetime.datetime.now().timestamp())) + (f"-{attempt}" if attempt else ""), "utf-8")).hexdigest()[:5]
+                if ChannelInfo.getSession(sessionid) is None and not glob.glob(f"./Sessions/{sessionid}.*"):
+                    break
             # Start single player game
             await message.channel.send(f"Starting single-player game! Please Wait!\nSession ID: {sessionid}\n(Tip: Make sure to save before leaving!)", delete_after=60)
             # Link the rom to romlink (so that channelid is included for the save files)
             # This is required so that the emulator saves to the romlink path,
             # Allowing single player saves to work without copying the rom every time.
-            os.system(f"ln -sf {rom} {romlink}")
-            pyboy = startPyBoy(romlink)
+            linkRom(rom, romlink)
+            session = Session("single", None, permanent, romlink, sessionid, message.channel.id)
+            # Claim a booted instance if there's one ready
+            pyboy = await Pool.claim(rom, romlink, session.journalpath)
+            if pyboy is None:
+                pyboy = await startEmulator(romlink, None, session.journalpath)
+            session.instance = pyboy
             # Send the update message
-            UpdateMessage = await message.channel.send("", embed=GetEmbed(f"Displaying Game!").set_image(url=await uploadScreenshot(screenshot(pyboy))))
-            # Add the pyboy instance to the list
-            ChannelInfo[message.channel.id] = {"type": "single", "instance": pyboy, "message": UpdateMessage, "removecounter": int(datetime.datetime.now().timestamp()) + 1800, "permanent": permanent, "filepath": romlink, "sessionid": sessionid, "refer": message.channel.id, "playercount": 1, "VoteCounts": {"🅰": 0, "🅱": 0, "⬆": 0, "⬇": 0, "⬅": 0, "➡": 0, "▶": 0, "🟦": 0, "🕐": 0}, "TimerActive": False, "UsersReacted": {}}
+            frame = Viewer(message.channel.id, session, None, None, "")
+            await refreshFrame(pyboy, [frame])
+            UpdateMessage = await message.channel.send("", embed=GetEmbed(f"Displaying Game!").set_image(url=frame.image))
+            # Add the session to the list, with this channel as it's host
+            ChannelInfo.addSession(session)
+            ChannelInfo.addViewer(session, message.channel.id, UpdateMessage, frame.frame, frame.image)
             # Add control emojis to the message
-            for emoji in list("🅰🅱⬅⬆⬇➡▶🟦🕐"):
-                await UpdateMessage.add_reaction(emoji)
+            Outbound.addReactions(UpdateMessage, list("🅰🅱⬅⬆⬇➡▶🟦🕐"))
+
+            # Permanent games are never kicked for inactivity
+            if not permanent:
+                Expiry.add(session)
+
+        if message.content.lower().startswith("pa!do"):
+            viewer = ChannelInfo.get(message.channel.id)
+            if viewer is None:
+                await message.channel.send("There's no game active in the channel!")
+                return
+            session = viewer.session
+            # Sequences skip voting, so they only work when playing alone
+            if session.playercount != 1:
+                await message.channel.send("Input sequences only work when playing alone!", delete_after=20)
+                return
+            Emojis = parseInputSequence(message.content[len("pa!do"):])
+            if Emojis is None:
+                await message.channel.send(f"That's not a valid input sequence!\nUse up to {MaxInputSequence} of `a b up down left right start select wait`, repeat one with `*`, like `PA!Do up*5 a`", delete_after=20)
+                return
+            Expiry.touch(session if session.type == "single" else viewer)
+            await runInputs(session, Emojis)
 
-            # If the game is supposed to not kick for inactivity
-            if permanent:
+        if message.content.lower().startswith("pa!turbo"):
+            viewer = ChannelInfo.get(message.channel.id)
+            if viewer is None:
+                await message.channel.send("There's no game active in the channel!")
                 return
-            # Get the current timestamp
-            timenowunix = int(datetime.datetime.now().timestamp())
-            try:
-                # While the set "go inactive" time is later than right now
-                while ChannelInfo[message.channel.id]["removecounter"] > timenowunix:
-                    # Sleep untill the player should be kicked for inactivity if they don't press any buttons
-                    await asyncio.sleep(ChannelInfo[message.channel.id]["removecounter"] - timenowunix + 1)
-                    # Reset current time
-                    timenowunix = int(datetime.datetime.now().timestamp())
-            except KeyError:
-                # We except KeyError here because it's possible that ChannelInfo[message.channel.id] has been removed by PA!Leave
+            session = viewer.session
+            # Fast-forwarding skips voting, so it only works when playing alone
+            if session.playercount != 1:
+                await message.channel.send("Turbo only works when playing alone!", delete_after=20)
                 return
-            # Leaves the current game
-            info = ChannelInfo[message.channel.id]
-            info["instance"].stop(save=True)
+            splitcontent = message.content.split(" ")
+            if len(splitcontent) != 2 or not splitcontent[1].isdecimal() or not 0 < int(splitcontent[1]) <= MaxTurboSeconds:
+                await message.channel.send(f"Please give an amount of seconds to fast-forward, up to {MaxTurboSeconds}! (Like `PA!Turbo 10`)", delete_after=20)
+                return
+            Expiry.touch(session if session.type == "single" else viewer)
             try:
-                for channelid in list(ChannelInfo.keys()):
-                    channel = ChannelInfo[channelid]
-                    if channel["refer"] == message.channel.id:
-                        try:
-                            await channel["message"].edit(embed=GetEmbed("Kicked due to inactivity!"))
-                            await channel["message"].clear_reactions()
-                        except:
-                            pass
-            except:
-                pass
-            ChannelInfo.pop(message.channel.id)
+                EmbedText = await runOnInstance(session, lambda instance: instance.turbo(int(splitcontent[1])))
+                await runOnInstance(session, lambda instance: refreshFrame(instance, [viewer]))
+            except EmulatorError as e:
+                print(f"Could not fast-forward session {session.sessionid}: {e}")
+                await message.channel.send("The game could not be run, please try again!", delete_after=20)
+                return
+            Outbound.edit(viewer.message, GetEmbed(EmbedText).set_image(url=viewer.image))
+
+        if message.content.lower() == "pa!stats":
+            # Stats are about every server, so only the bot's own admins can see them
+            if not await isBotAdmin(message.author):
+                await message.channel.send("Only the bot's admins can see the bot's stats!", delete_after=20)
+                return
+            await message.channel.send("", embed=GetEmbed(f"```\n{Metrics.getSummary()[:2000]}\n```"))
 
         if message.content.lower().startswith("pa!leave"):
             # Leaves the current game
-            try:
-                info = ChannelInfo[message.channel.id]
-            except KeyError:
+            viewer = ChannelInfo.get(message.channel.id)
+            if viewer is None:
                 await message.channel.send("There's no game active in the channel!")
                 return
-            # If it's a single player game, stop the instance
-            if info["type"] == "single":
-                if info["permanent"]:
-                    if not message.author.permissions_in(message.channel).administrator:
-                        await message.channel.send("Only administrators can close permanent games!")
-                        return
-                if info["refer"] == message.channel.id:
-                    # This channel is the single player game host.
-                    info["instance"].stop(save=True)
-                    for channelid in list(ChannelInfo.keys()):
-                        if ChannelInfo[channelid]["refer"] == message.channel.id and channelid != message.channel.id:
-                            try:
-                                await ChannelInfo[channelid]["message"].edit(embed=GetEmbed("Game host stopped playing!"))
-                                await ChannelInfo[channelid]["message"].clear_reactions()
-                                await asyncio.sleep(1)
-                            except:
-                                pass
-                            ChannelInfo.pop(channelid)
-                else:
-                    ChannelInfo[info["refer"]]["playercount"] -= 1
+            session = viewer.session
+            if session.type == "single" and session.permanent:
+                if not message.author.permissions_in(message.channel).administrator:
+                    await message.channel.send("Only administrators can close permanent games!")
+                    return
+            # If this channel hosts a single player game, stop the instance
+            if session.refer == message.channel.id:
+                for other in ChannelInfo.removeSession(session):
+                    if other is not viewer:
+                        Outbound.edit(other.message, GetEmbed("Game host stopped playing!"), clear=True)
+                await stopSession(session)
             else:
-                ChannelInfo[info["refer"]]["playercount"] -= 1
-            try:
-                await info["message"].edit(embed=GetEmbed("Stopped Playing!"))
-                await info["message"].clear_reactions()
-            except:
-                pass
-            ChannelInfo.pop(message.channel.id)
+                ChannelInfo.removeViewer(viewer)
+            Outbound.edit(viewer.message, GetEmbed("Stopped Playing!"), clear=True)
 
 
     async def on_raw_reaction_add(self, payload):
         # "🅰🅱⬆⬇⬅➡▶🟦🕐"
         # VoteCounts = {"🅰": 0, "🅱": 0, "⬆": 0, "⬇": 0, "⬅": 0, "➡": 0, "▶": 0, "🟦": 0, "🕐": 0}
-        global ChannelInfo
         if payload.user_id == client.user.id:
             return
-        if payload.channel_id in ChannelInfo.keys():
-            info = ChannelInfo[payload.channel_id]
-            if info["message"].id == payload.message_id:
-                if payload.event_type == "REACTION_ADD":
-                    if str(payload.emoji) in "🅰🅱⬆⬇⬅➡▶🟦🕐":
-                        try:
-                            await info["message"].remove_reaction(payload.emoji, payload.member)
-                        except:
-                            pass
-                        if info["type"] == "single":
-                            ChannelInfo[info["refer"]]["removecounter"] = max(int(datetime.datetime.now().timestamp()) + 1800, ChannelInfo[info["refer"]]["removecounter"])
-                        else:
-                            ChannelInfo[payload.channel_id]["removecounter"] = max(int(datetime.datetime.now().timestamp()) + 1800, info["removecounter"])
-                        instance = info["instance"]
-                        if ChannelInfo[info["refer"]]["playercount"] == 1:
-                            EmbedText = DoActionOnEmoji(instance, str(payload.emoji))
-                            try:
-                                await info["message"].edit(embed=GetEmbed(EmbedText).set_image(url=await uploadScreenshot(screenshot(instance))))
-                            except:
-                                pass
-                        else:
-                            ChannelInfo[info["refer"]]["UsersReacted"][payload.user_id] = str(payload.emoji)
-                            if not ChannelInfo[info["refer"]]["TimerActive"]:
-                                ChannelInfo[info["refer"]]["TimerActive"] = True
-                                playerCount = ChannelInfo[info["refer"]]["playercount"]
-                                await asyncio.sleep(min(playerCount, 5))
-                                ChannelInfo[info["refer"]]["VoteCounts"] = {"🅰": 0, "🅱": 0, "⬆": 0, "⬇": 0, "⬅": 0, "➡": 0, "▶": 0, "🟦": 0, "🕐": 0}
-                                for user in list(ChannelInfo[info["refer"]]["UsersReacted"].keys()):
-                                    emoji = ChannelInfo[info["refer"]]["UsersReacted"][user]
-                                    ChannelInfo[info["refer"]]["VoteCounts"][emoji] += 1
-                                FinalEmoji = sorted(ChannelInfo[info["refer"]]["VoteCounts"], key=ChannelInfo[info["refer"]]["VoteCounts"].get, reverse=True)[0]
-                                ChannelInfo[info["refer"]]["TimerActive"] = False
-
-                                EmbedText = DoActionOnEmoji(ChannelInfo[info["refer"]]["instance"], FinalEmoji)
-                                EmbedText += f"\nPlayers: {playerCount}\n"
-                                for emoji in list(ChannelInfo[info["refer"]]["VoteCounts"].keys()):
-                                    EmbedText += f"{emoji}: {ChannelInfo[info['refer']]['VoteCounts'][emoji]} "
-                                UsersReacted = {}
-                                # Screenshot and upload
-                                screenshoturl = await uploadScreenshot(screenshot(ChannelInfo[info["refer"]]["instance"]))
-                                for channelid in list(ChannelInfo.keys()):
-                                    channel = ChannelInfo[channelid]
-                                    if channel["refer"] == info["refer"]:
-                                        try:
-                                            await channel["message"].edit(embed=GetEmbed(EmbedText).set_image(url=screenshoturl))
-                                        except:
-                                            pass
-
-client = MyClient()
-client.run(Settings["Token"])
+        viewer = ChannelInfo.get(payload.channel_id)
+        if viewer is None or viewer.message.id != payload.message_id:
+            return
+        if payload.event_type != "REACTION_ADD" or str(payload.emoji) not in "🅰🅱⬆⬇⬅➡▶🟦🕐":
+            return
+        Outbound.removeReaction(viewer.message, payload.emoji, payload.member)
+        Metrics.count("reactions")
+        session = viewer.session
+        Expiry.touch(session if session.type == "single" else viewer)
+        if session.playercount == 1:
+            await runInputs(session, [str(payload.emoji)])
+        # Only the player that opens a round waits for it
+        elif session.votes.vote(payload.user_id, str(payload.emoji), session.playercount):
+            roundstart = time.perf_counter()
+            playerCount = session.playercount
+            FinalEmoji, VoteCounts = await session.votes.collect(playerCount)
+            Metrics.observe("vote_round", time.perf_counter() - roundstart)
+            # Wait for the action of the previous round to finish
+            async with session.votes.getLock():
+                # The session could have stopped while voting
+                if ChannelInfo.getSession(session.sessionid) is not session:
+                    return
+                channels = list(session.viewers.values())
+                try:
+                    EmbedText = await runOnInstance(session, lambda instance: instance.action(FinalEmoji))
+                    # Screenshot and upload, for channels that don't show this frame yet
+                    await runOnInstance(session, lambda instance: refreshFrame(instance, channels))
+                except EmulatorError as e:
+                    print(f"Could not run the vote on session {session.sessionid}: {e}")
+                    for channel in channels:
+                        Outbound.edit(channel.message, GetEmbed("The game could not be run, please try again!").set_image(url=channel.image))
+                    return
+                EmbedText += f"\nPlayers: {playerCount}\n"
+                for emoji in list(VoteCounts.keys()):
+                    EmbedText += f"{emoji}: {VoteCounts[emoji]} "
+                for channel in channels:
+                    Outbound.edit(channel.message, GetEmbed(EmbedText).set_image(url=channel.image))
+                Metrics.observe("press_to_frame", time.perf_counter() - roundstart)
+
+endStartupPhase("setup")
+
+if __name__ == "__main__":
+    startEmulatorWorkers()
+    endStartupPhase("workers")
+    client = MyClient()
+    client.run(Settings["Token"])
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+
+# Pokémon Arcade benchmarks
+# Measures parts of the bot without a Discord connection
+# By default a small homebrew rom is generated, so no (copyrighted) rom is needed
+
+# Builtins
+import os
+import sys
+import io
+import time
+import json
+import types
+import random
+import asyncio
+import argparse
+import tempfile
+import itertools
+import statistics
+
+# Nintendo Logo, required in the header of every rom
+NintendoLogo = "CEED6666CC0D000B03730083000C000D0008111F8889000EDCCC6EE6DDDDD999BBBB67636E0EECCCDDDC999FBBB9333E"
+
+# Assemble a list of opcodes, labels and jumps to labels
+# Jumps are ("jr", opcode, label) or ("jp", label)
+def assemble(program, origin):
+    labels = {}
+    # The first pass finds the labels, the second pass uses them
+    for i in range(2):
+        code = bytearray()
+        for item in program:
+            if isinstance(item, str):
+                labels[item] = origin + len(code)
+            elif item[0] == "jr":
+                target = labels.get(item[2], origin)
+                code += bytes([item[1], (target - (origin + len(code) + 2)) & 0xFF])
+            elif item[0] == "jp":
+                target = labels.get(item[1], origin)
+                code += bytes([0xC3, target & 0xFF, target >> 8])
+            else:
+                code += bytes(item)
+    return bytes(code)
+
+# Build a homebrew test rom, free to redistribute
+# It fills the screen with a tile pattern, scrolls it with the d-pad and inverts the palette with A
+def buildTestRom():
+    program = [
+        # di
+        (0xF3,),
+        # Fill the tile data with a pattern: ld hl, $8000; ld a, l; xor h; ld [hl+], a; ld a, h; cp $88
+        (0x21, 0x00, 0x80), "tiles", (0x7D, 0xAC, 0x22, 0x7C, 0xFE, 0x88), ("jr", 0x20, "tiles"),
+        # Fill the tile map: ld hl, $9800; ld a, l; and $7F; ld [hl+], a; ld a, h; cp $9C
+        (0x21, 0x00, 0x98), "map", (0x7D, 0xE6, 0x7F, 0x22, 0x7C, 0xFE, 0x9C), ("jr", 0x20, "map"),
+        # Set the palette, and turn on the screen with the background
+        (0x3E, 0xE4, 0xE0, 0x47, 0x3E, 0x91, 0xE0, 0x40),
+        "main",
+        # Wait for vblank
+        "vblank", (0xF0, 0x44, 0xFE, 0x90), ("jr", 0x20, "vblank"),
+        # Read the d-pad into b, and the buttons into c
+        (0x3E, 0x20, 0xE0, 0x00, 0xF0, 0x00, 0xF0, 0x00, 0x2F, 0xE6, 0x0F, 0x47),
+        (0x3E, 0x10, 0xE0, 0x00, 0xF0, 0x00, 0xF0, 0x00, 0x2F, 0xE6, 0x0F, 0x4F),
+        (0x3E, 0x30, 0xE0, 0x00),
+        # Right and left change SCX, up and down change SCY
+        (0xCB, 0x40), ("jr", 0x28, "noright"), (0xF0, 0x43, 0x3C, 0xE0, 0x43), "noright",
+        (0xCB, 0x48), ("jr", 0x28, "noleft"), (0xF0, 0x43, 0x3D, 0xE0, 0x43), "noleft",
+        (0xCB, 0x50), ("jr", 0x28, "noup"), (0xF0, 0x42, 0x3D, 0xE0, 0x42), "noup",
+        (0xCB, 0x58), ("jr", 0x28, "nodown"), (0xF0, 0x42, 0x3C, 0xE0, 0x42), "nodown",
+        # A inverts the palette
+        (0xCB, 0x41), ("jr", 0x28, "noa"), (0xF0, 0x47, 0x2F, 0xE0, 0x47), "noa",
+        # Wait for vblank to end, so the loop runs once per frame
+        "frame", (0xF0, 0x44, 0xFE, 0x90), ("jr", 0x28, "frame"),
+        ("jp", "main"),
+    ]
+    rom = bytearray(0x8000)
+    # Entry point: nop; jp $0150
+    rom[0x100:0x104] = bytes([0x00, 0xC3, 0x50, 0x01])
+    rom[0x104:0x134] = bytes.fromhex(NintendoLogo)
+    rom[0x134:0x144] = b"PA BENCHMARK".ljust(16, b"\0")
+    # Header checksum
+    checksum = 0
+    for byte in rom[0x134:0x14D]:
+        checksum = (checksum - byte - 1) & 0xFF
+    rom[0x14D] = checksum
+    code = assemble(program, 0x150)
+    rom[0x150:0x150 + len(code)] = code
+    # Global checksum, not checked by hardware but nice to have
+    rom[0x14E:0x150] = ((sum(rom) - rom[0x14E] - rom[0x14F]) & 0xFFFF).to_bytes(2, "big")
+    return bytes(rom)
+
+# Import the bot in a temporary working directory, so real settings, caches and saves are not touched
+# Returns the module, and the rom path used for every game
+def loadBot(rom=None, settings={}):
+    directory = tempfile.mkdtemp(prefix="PokemonArcadeBenchmark-")
+    romfile = os.path.join(directory, "benchmark.gb")
+    if rom is None:
+        with open(romfile, "wb") as f:
+            f.write(buildTestRom())
+    else:
+        with open(rom, "rb") as src, open(romfile, "wb") as f:
+            f.write(src.read())
+    botsettings = {"Token": "", "IconURL": "", "SupportServerURL": "", "ImageChannelID": 1, "RomLocations": {"red": romfile, "blue": romfile, "yellow": romfile}}
+    botsettings.update(settings)
+    with open(os.path.join(directory, "PokemonArcade_Settings.json"), "w") as f:
+        json.dump(botsettings, f)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(directory)
+    import PokemonArcade
+    return PokemonArcade, romfile
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+# Compare the old RGB png path with the palette encoder, on frames from random play
+def benchmarkEncoders(args):
+    bot, rom = loadBot(args.rom)
+    from PIL import Image
+    pyboy = bot.startPyBoy(rom)
+    random.seed(args.seed)
+    frames = {}
+    while len(frames) < args.frames:
+        bot.DoActionOnEmoji(pyboy, random.choice(list(bot.emojiToButtonMap) + ["🕐"]))
+        fingerprint, frame = bot.captureFrame(pyboy)
+        frames[fingerprint] = frame
+    pyboy.stop(save=False)
+
+    # The encoder as it was before palette encoding
+    def legacy(frame):
+        img = frame.convert("RGBA").resize((frame.size[0] * 3, frame.size[1] * 3), 0)
+        buffer = io.BytesIO()
+        img.save(buffer, "PNG")
+        return buffer.getvalue()
+
+    encoders = {"legacy png (RGBA)": legacy, "palette png": lambda frame: bot.encodeFrame(frame, "png"), "palette webp (lossless)": lambda frame: bot.encodeFrame(frame, "webp")}
+    print(f"{len(frames)} unique frames\n")
+    print(f"{'encoder':<26}{'mean size':>12}{'p50 ms':>10}{'p95 ms':>10}")
+    for name, encoder in encoders.items():
+        sizes = []
+        times = []
+        for frame in frames.values():
+            start = time.perf_counter()
+            sizes.append(len(encoder(frame)))
+            times.append((time.perf_counter() - start) * 1000)
+        print(f"{name:<26}{statistics.mean(sizes):>10.0f} B{percentile(times, 50):>10.2f}{percentile(times, 95):>10.2f}")
+
+# Stand-ins for the discord.py objects the bot uses
+# Every request sleeps for the given latency, like a round trip to discord would
+MessageIDs = itertools.count(1000)
+
+class FakeMessage:
+    def __init__(self, channel, content="", embed=None, author=None, attachments=[]):
+        self.id = next(MessageIDs)
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.embed = embed
+        self.author = author
+        self.attachments = attachments
+        self.edits = 0
+        # Times of reactions that are waiting for an edit
+        self.presses = []
+
+    async def edit(self, embed=None):
+        await asyncio.sleep(self.channel.latency)
+        self.channel.log.append((self.id, "edit", embed))
+        self.embed = embed
+        self.edits += 1
+        now = time.perf_counter()
+        self.channel.pressToEdit.extend(now - press for press in self.presses)
+        self.presses = []
+
+    async def add_reaction(self, emoji):
+        await asyncio.sleep(self.channel.latency)
+        self.channel.log.append((self.id, "add", emoji))
+
+    async def remove_reaction(self, emoji, member):
+        await asyncio.sleep(self.channel.latency)
+        self.channel.log.append((self.id, "remove", emoji))
+
+    async def clear_reactions(self):
+        await asyncio.sleep(self.channel.latency)
+        self.channel.log.append((self.id, "clear", None))
+
+    async def delete(self):
+        await asyncio.sleep(self.channel.latency)
+
+class FakeChannel:
+    def __init__(self, channelid, latency, pressToEdit):
+        self.id = channelid
+        self.type = "text"
+        self.guild = types.SimpleNamespace(large=False)
+        self.latency = latency
+        self.pressToEdit = pressToEdit
+        # Finished requests, as (message id, request, argument)
+        self.log = []
+
+    async def send(self, content="", embed=None, file=None, files=[], delete_after=None):
+        await asyncio.sleep(self.latency)
+        attachments = [types.SimpleNamespace(filename=file.filename, url=f"https://cdn.example/{file.filename}") for file in ([file] if file else files)]
+        return FakeMessage(self, content, embed, attachments=attachments)
+
+class FakeAuthor:
+    bot = False
+
+    def __init__(self, userid):
+        self.id = userid
+
+    def permissions_in(self, channel):
+        return types.SimpleNamespace(administrator=True)
+
+# Returns a client that handles events like the bot would, without connecting to discord
+def makeFakeClient(bot, latency, pressToEdit):
+    channels = {}
+    class FakeClient(bot.MyClient):
+        user = types.SimpleNamespace(id=1)
+
+        def get_channel(self, channelid):
+            if channelid not in channels:
+                channels[channelid] = FakeChannel(channelid, latency, pressToEdit)
+            return channels[channelid]
+    bot.client = FakeClient()
+    return bot.client
+
+# CPU seconds and resident memory in bytes of a process, from /proc
+def getProcessUsage(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # The process name can contain spaces, the fields after it can't
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open(f"/proc/{pid}/statm") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK"), pages * os.sysconf("SC_PAGE_SIZE")
+
+# Play games on fake channels with random reactions, and measure how the bot keeps up
+def benchmarkLoad(args):
+    bot, rom = loadBot(args.rom, {"EmulatorWorkers": args.workers, "HibernateAfter": 0, "MetricsInterval": 0, "InputBatchWindow": args.batch_window})
+    random.seed(args.seed)
+    bot.startEmulatorWorkers()
+    pressToEdit = []
+    client = makeFakeClient(bot, args.latency / 1000, pressToEdit)
+    loop = asyncio.get_event_loop()
+
+    async def run():
+        tasks = []
+        # Every game is hosted by a channel, other channels join it so players have to vote
+        channelids = itertools.count(100)
+        games = []
+        for i in range(args.channels):
+            host = client.get_channel(next(channelids))
+            tasks.append(asyncio.ensure_future(client.on_message(FakeMessage(host, "PA!Singleplayer", author=FakeAuthor(2)))))
+            games.append([host])
+        while any(game[0].id not in bot.ChannelInfo for game in games):
+            await asyncio.sleep(0.05)
+        for game in games:
+            sessionid = bot.ChannelInfo[game[0].id].session.sessionid
+            for i in range(args.join):
+                channel = client.get_channel(next(channelids))
+                tasks.append(asyncio.ensure_future(client.on_message(FakeMessage(channel, f"PA!Join {sessionid}", author=FakeAuthor(2)))))
+                game.append(channel)
+        channels = [channel for game in games for channel in game]
+        while any(channel.id not in bot.ChannelInfo for channel in channels):
+            await asyncio.sleep(0.05)
+        # Wait for the reactions of the game messages to be added
+        while bot.Outbound.pending:
+            await asyncio.sleep(0.05)
+
+        userids = itertools.count(10)
+        reactions = 0
+        async def play(channel, userid):
+            nonlocal reactions
+            viewer = bot.ChannelInfo[channel.id]
+            member = types.SimpleNamespace(id=userid)
+            while True:
+                await asyncio.sleep(random.expovariate(args.rate))
+                emoji = random.choice(list(bot.emojiToButtonMap) + ["🕐"])
+                viewer.message.presses.append(time.perf_counter())
+                payload = types.SimpleNamespace(user_id=userid, channel_id=channel.id, message_id=viewer.message.id, event_type="REACTION_ADD", emoji=emoji, member=member)
+                # discord.py runs every event in it's own task
+                tasks.append(asyncio.ensure_future(client.on_raw_reaction_add(payload)))
+                reactions += 1
+
+        workers = [worker.process.pid for worker in bot.EmulatorWorkers]
+        before = {pid: getProcessUsage(pid) for pid in workers + [os.getpid()]}
+        pressToEdit.clear()
+        start = time.perf_counter()
+        players = [asyncio.ensure_future(play(channel, next(userids))) for channel in channels for i in range(args.players)]
+        await asyncio.sleep(args.duration)
+        for player in players:
+            player.cancel()
+        elapsed = time.perf_counter() - start
+        # Let the last presses finish
+        await asyncio.sleep(6)
+        while bot.Outbound.pending:
+            await asyncio.sleep(0.05)
+        after = {pid: getProcessUsage(pid) for pid in workers + [os.getpid()]}
+        for task in tasks:
+            task.cancel()
+
+        sessions = len(games)
+        print(f"{sessions} games, {len(channels)} channels, {len(players)} players, {args.rate} reactions/s per player, {args.latency}ms discord latency\n")
+        print(f"reactions:       {reactions} ({reactions / elapsed:.1f}/s)")
+        print(f"edits:           {sum(bot.ChannelInfo[channel.id].message.edits for channel in channels)}")
+        if pressToEdit:
+            print(f"press to edit:   p50 {percentile(pressToEdit, 50) * 1000:.1f}ms, p95 {percentile(pressToEdit, 95) * 1000:.1f}ms, p99 {percentile(pressToEdit, 99) * 1000:.1f}ms")
+        if all(before.values()) and all(after.values()):
+            workercpu = sum(after[pid][0] - before[pid][0] for pid in workers)
+            workermemory = sum(after[pid][1] for pid in workers)
+            print(f"worker cpu:      {workercpu / elapsed * 100:.1f}% total, {workercpu / elapsed / sessions * 100:.2f}% per game")
+            print(f"worker memory:   {workermemory / 2 ** 20:.1f}MB total, {workermemory / sessions / 2 ** 20:.2f}MB per game")
+            print(f"bot cpu:         {(after[os.getpid()][0] - before[os.getpid()][0]) / elapsed * 100:.1f}%, memory {after[os.getpid()][1] / 2 ** 20:.1f}MB")
+        else:
+            print("cpu and memory:  not available without /proc")
+        print(f"\n{bot.Metrics.getSummary()}")
+        if args.max_p95 and pressToEdit and percentile(pressToEdit, 95) * 1000 > args.max_p95:
+            print(f"\nPress to edit p95 is over {args.max_p95}ms")
+            return 1
+        return 0
+
+    sys.exit(loop.run_until_complete(run()))
+
+# Check the ordering rules of the outbound scheduler against fake messages
+def checkScheduler(args):
+    bot, rom = loadBot()
+    channel = FakeChannel(1, args.latency / 1000, [])
+    member = types.SimpleNamespace(id=2)
+
+    def requests(message):
+        return [(request, argument) for messageid, request, argument in channel.log if messageid == message.id]
+
+    async def run():
+        scheduler = bot.OutboundScheduler(16)
+
+        # Edits made while an edit is running are replaced by the newest one
+        message = FakeMessage(channel)
+        scheduler.edit(message, "1")
+        await asyncio.sleep(0)
+        for embed in "2345":
+            scheduler.edit(message, embed)
+        await asyncio.sleep(args.latency / 1000 * 4)
+        assert requests(message) == [("edit", "1"), ("edit", "5")], requests(message)
+        print("ok: only the newest pending edit is sent")
+
+        # An edit goes before the reactions that are still waiting
+        message = FakeMessage(channel)
+        scheduler.addReactions(message, list("abc"))
+        await asyncio.sleep(0)
+        scheduler.edit(message, "new")
+        await asyncio.sleep(args.latency / 1000 * 5)
+        assert requests(message) == [("add", "a"), ("edit", "new"), ("add", "b"), ("add", "c")], requests(message)
+        print("ok: edits go before waiting reactions")
+
+        # Clearing the reactions drops the reactions that are still waiting
+        message = FakeMessage(channel)
+        scheduler.addReactions(message, list("abc"))
+        await asyncio.sleep(0)
+        scheduler.edit(message, "stopped", clear=True)
+        await asyncio.sleep(args.latency / 1000 * 4)
+        assert requests(message) == [("add", "a"), ("edit", "stopped"), ("clear", None)], requests(message)
+        print("ok: clearing drops waiting reactions")
+
+        # Reaction removals wait for the message work to finish
+        editing = FakeMessage(channel)
+        reacted = FakeMessage(channel)
+        scheduler.edit(editing, "busy")
+        scheduler.removeReaction(reacted, "a", member)
+        scheduler.removeReaction(reacted, "a", member)
+        await asyncio.sleep(args.latency / 1000 * 4)
+        log = [(messageid, request) for messageid, request, argument in channel.log]
+        assert log.index((editing.id, "edit")) < log.index((reacted.id, "remove")), log
+        assert requests(reacted) == [("remove", "a")], requests(reacted)
+        print("ok: removals wait for edits, and are sent once")
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pokémon Arcade benchmarks, without a Discord connection")
+    parser.add_argument("--rom", help="Rom to use instead of the generated homebrew rom")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    commands = parser.add_subparsers(dest="command", required=True)
+    encoders = commands.add_parser("encoders", help="Compare frame encoders on size and encode time")
+    encoders.add_argument("--frames", type=int, default=100, help="Amount of unique frames to encode")
+    encoders.set_defaults(run=benchmarkEncoders)
+    scheduler = commands.add_parser("scheduler", help="Check the ordering rules of the outbound scheduler")
+    scheduler.add_argument("--latency", type=float, default=50, help="Milliseconds every fake discord request takes")
+    scheduler.set_defaults(run=checkScheduler)
+    load = commands.add_parser("load", help="Play games on fake discord channels, and measure reactions/s, latency, cpu and memory")
+    load.add_argument("--channels", type=int, default=8, help="Amount of single player games, each hosted by a channel")
+    load.add_argument("--join", type=int, default=0, help="Amount of extra channels joining every game, so players vote")
+    load.add_argument("--players", type=int, default=1, help="Amount of players reacting in every channel")
+    load.add_argument("--rate", type=float, default=1, help="Reactions per second of every player")
+    load.add_argument("--duration", type=float, default=30, help="Seconds to play")
+    load.add_argument("--latency", type=float, default=50, help="Milliseconds every fake discord request takes")
+    load.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Amount of emulator processes")
+    load.add_argument("--batch-window", type=float, default=0, help="InputBatchWindow setting of the bot")
+    load.add_argument("--max-p95", type=float, default=0, help="Exit with an error when the press to edit p95 is over this many milliseconds")
+    load.set_defaults(run=benchmarkLoad)
+    args = parser.parse_args()
+    args.run(args)